@@ -1,11 +1,16 @@
 import ftplib
 import argparse
 import time
-import os
 import csv
+import posixpath
+import queue
+import threading
 
 VERBOSE = True
 
+FTP_HOST = "ftp.geo.euskadi.net"
+ROOT_PATH = "/cartografia/Transporte/Moveuskadi/"
+
 parser = argparse.ArgumentParser(description='Download GTFS feeds from Euskadi FTP server')
 parser.add_argument(
     '--ignore_keywords',
@@ -19,79 +24,170 @@ parser.add_argument(
     default='feed_urls.csv',
     help='CSV file to log feed URLs and metadata'
 )
+parser.add_argument(
+    '--ftp-workers',
+    type=int,
+    default=4,
+    help='Number of concurrent FTP connections used to crawl the server (default: 4)'
+)
 args = parser.parse_args()
 
-ftp = ftplib.FTP("ftp.geo.euskadi.net")
-ftp.login()  # Anonymous login
-
-all_feeds = []
-
-file_exists = os.path.isfile(args.logging_file)
-with open(args.logging_file, 'a', newline='') as csvfile:
-    fieldnames = [
-        'url', 'run_id', 'time_added', 'source',
-        'id', 'country', 'license', 'known_status'
-    ]
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-    if not file_exists:
-        writer.writeheader()
-
-    def collect_all_feed_links(ftp, path):
-        """Recursively search the FTP server for .zip GTFS feeds."""
-        # Check ignore conditions
-        if any(keyword.lower() in path.lower() for keyword in args.ignore_keywords):
-            if VERBOSE:
-                print(f"Ignoring path (matched keyword): {path}")
-            return
-
-        try:
-            original_path = ftp.pwd()
-            ftp.cwd(path)
-        except ftplib.error_perm as e:
-            if VERBOSE:
-                print(f"Permission error accessing {path}: {e}")
-            return
+# Run metadata, identical for every row logged by this run
+RUN_ID = f'euskadi_{time.strftime("%Y%m%d")}'
+RUN_TS = int(time.time())
+# Every column except the URL is constant for this source
+ROW_SUFFIX = (RUN_ID, RUN_TS, 'euskadi', '', 'ES', '', 'active')
+
+ignore_keywords = tuple(keyword.lower() for keyword in args.ignore_keywords)
+
+# Listings failing on a dropped connection are retried on a new one this many times in total
+MAX_ATTEMPTS = 3
+
+
+def connect():
+    """Open an anonymous FTP connection in binary mode."""
+    ftp = ftplib.FTP(FTP_HOST, timeout=60)  # A stalled connection raises instead of blocking its worker
+    ftp.login()  # Anonymous login
+    ftp.voidcmd('TYPE I')  # Binary mode, required by SIZE on most servers
+    return ftp
+
+
+def close(ftp):
+    """Close a connection that may already be dead."""
+    try:
+        ftp.quit()
+    except ftplib.all_errors:
+        ftp.close()
+
+
+def classify_entry(ftp, path):
+    """Return 'file' or 'dir' for a path without changing into it.
+
+    SIZE only succeeds on regular files, so a permanent error marks a
+    directory. This costs one round-trip instead of a cwd and cwd back.
+    """
+    try:
+        ftp.size(path)
+        entry_type = 'file'
+    except ftplib.error_perm:
+        entry_type = 'dir'
+    if VERBOSE:
+        print(f"Classified {path} as {entry_type}")
+    return entry_type
+
+
+def list_directory(ftp, path):
+    """List a directory as (name, type) pairs.
+
+    MLSD returns the entry type in the same round-trip; servers without
+    MLSD support fall back to NLST and a SIZE probe per entry.
+    """
+    try:
+        return [(name, facts.get('type')) for name, facts in ftp.mlsd(path, facts=['type'])]
+    except ftplib.error_perm:
+        names = [posixpath.basename(name) for name in ftp.nlst(path)]
+        return [(name, classify_entry(ftp, posixpath.join(path, name))) for name in names]
+
+
+def crawl_worker(ftp, directories, feed_links, attempts):
+    """Consume directory paths from the queue until a None sentinel is received.
+
+    Subdirectories are put back on the queue, so the server is crawled
+    breadth-first by all workers, each on its own FTP connection. A connection
+    lost to a timeout or EOF is replaced and the path is queued again, so its
+    subtree is not silently dropped. The connection is closed on exit.
+    """
+    while True:
+        path = directories.get()
+        if path is None:
+            directories.task_done()
+            break
 
         try:
-            files = ftp.nlst()
-        except ftplib.error_perm as e:
-            if VERBOSE:
-                print(f"Error listing directory {path}: {e}")
-            ftp.cwd(original_path)
-            return
-
-        for file in files:
-            # Recursively dive into subfolders (skip files)
-            if '.' not in file:
-                collect_all_feed_links(ftp, file)
+            # Check ignore conditions
+            if any(keyword in path.lower() for keyword in ignore_keywords):
+                if VERBOSE:
+                    print(f"Ignoring path (matched keyword): {path}")
                 continue
 
-            # If it’s a .zip file, treat it as a GTFS feed
-            if file.lower().endswith(".zip"):
-                current_path = ftp.pwd()
-                feed_link = f"ftp://ftp.geo.euskadi.net{current_path}/{file}"
-                all_feeds.append(feed_link)
+            try:
+                if ftp is None:
+                    ftp = connect()
+                entries = list_directory(ftp, path)
+            except ftplib.error_perm as e:
                 if VERBOSE:
-                    print(f"Found feed link: {feed_link}")
+                    print(f"Error listing directory {path}: {e}")
+                continue
+            except ftplib.all_errors as e:
+                # The connection is unusable: drop it, reconnect on the next path and retry this one
+                if ftp is not None:
+                    ftp.close()
+                    ftp = None
+                attempts[path] = attempts.get(path, 0) + 1
+                if attempts[path] < MAX_ATTEMPTS:
+                    print(f"Connection lost while listing {path} ({e}), retrying")
+                    directories.put(path)
+                else:
+                    print(f"Giving up on {path} after {MAX_ATTEMPTS} attempts: {e}")
+                continue
 
-                writer.writerow({
-                    'url': feed_link,
-                    'run_id': f'euskadi_{time.strftime("%Y%m%d")}',
-                    'time_added': int(time.time()),
-                    'source': 'euskadi',
-                    'id': '',
-                    'country': 'ES',
-                    'license': '',
-                    'known_status': 'active'
-                })
+            for name, entry_type in entries:
+                full_path = posixpath.join(path, name)
+                if entry_type == 'dir':
+                    directories.put(full_path)
+
+                # If it’s a .zip file, treat it as a GTFS feed
+                elif entry_type == 'file' and name.lower().endswith(".zip"):
+                    feed_link = f"ftp://{FTP_HOST}{full_path}"
+                    feed_links.put(feed_link)
+                    if VERBOSE:
+                        print(f"Found feed link: {feed_link}")
+        except Exception as e:
+            # Keep the worker alive: directories.join() relies on every worker draining the queue
+            print(f"Unexpected error while crawling {path}: {e}")
+        finally:
+            directories.task_done()
+
+    if ftp is not None:
+        close(ftp)
+
+
+# Connections are opened up front so that a failing login stops the script immediately
+connections = [connect() for _ in range(max(1, args.ftp_workers))]
+
+directories = queue.Queue()
+feed_links = queue.Queue()
+directories.put(ROOT_PATH)
+attempts = {}
+
+workers = [
+    threading.Thread(target=crawl_worker, args=(ftp, directories, feed_links, attempts), daemon=True)
+    for ftp in connections
+]
+for worker in workers:
+    worker.start()
+
+# Wait until every discovered directory has been listed, then stop the workers
+directories.join()
+for _ in workers:
+    directories.put(None)
+for worker in workers:
+    worker.join()
+
+all_feeds = sorted(feed_links.queue)
 
-        # Go back up one directory level
-        ftp.cwd(original_path)
+with open(args.logging_file, 'a', newline='') as csvfile:
+    fieldnames = [
+        'url', 'run_id', 'time_added', 'source',
+        'id', 'country', 'license', 'known_status'
+    ]
+    writer = csv.writer(csvfile)
 
-    collect_all_feed_links(ftp, "/cartografia/Transporte/Moveuskadi/")
+    if csvfile.tell() == 0:
+        writer.writerow(fieldnames)
 
-ftp.quit()
+    # Same column order as `fieldnames`
+    writer.writerows((feed_link,) + ROW_SUFFIX for feed_link in all_feeds)
 
 if VERBOSE:
     print(f"\nFinished. Total feeds found: {len(all_feeds)}")
@@ -1,12 +1,19 @@
 import argparse
+import asyncio
+import aiofiles
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 import time
 import random
 from tqdm import tqdm
 import ftplib
 from urllib.parse import urlparse
 import os
+import queue
 import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -16,7 +23,14 @@ from tenacity import (
 from http.client import IncompleteRead
 import csv
 import hashlib
+import shutil
 import urllib3
+from urllib3.util.retry import Retry
+
+try:
+    import uvloop  # Faster event loop, not available on Windows
+except ImportError:
+    uvloop = None
 
 # ----------------------
 # Argument parser setup
@@ -28,6 +42,9 @@ parser.add_argument("file", type=str, help="CSV file containing URLs under a 'ur
 parser.add_argument("output", type=str, help="Folder to save downloaded .zip files")
 parser.add_argument("--timeout", type=int, default=30, help="Timeout in seconds for HTTP requests (default: 30)")
 parser.add_argument("--no-threads", action="store_true", help="Disable multi-threaded downloads")
+parser.add_argument("--workers", type=int, default=16, help="Number of concurrent downloads (default: 16)")
+parser.add_argument("--async", dest="use_async", action="store_true",
+                    help="Download HTTP(S) feeds with asyncio/aiohttp on a single thread (FTP still uses threads)")
 parser.add_argument("--no-verify", action="store_true", help="Disable SSL certificate verification for HTTPS")
 parser.add_argument("--logging_file", type=str, default="url_download.csv", help="CSV file to log download status")
 parser.add_argument("--retry_failed", action="store_true", help="Retry failed or missing downloads")
@@ -38,15 +55,101 @@ args = parser.parse_args()
 # Helper Functions
 # ----------------------
 
-def calculate_checksum(file_path):
-    """Return SHA256 checksum of the file, or None if file doesn't exist."""
-    if not os.path.exists(file_path):
-        return None
-    sha256_hash = hashlib.sha256()
+CHUNK_SIZE = 1024 * 1024  # Bytes read/written per iteration when downloading
+CHECKSUM_ALGORITHM = "blake2b"  # Content fingerprint only, faster than SHA256 in software
+
+
+def new_checksum():
+    """Return an empty hash object used to fingerprint downloaded files."""
+    return hashlib.blake2b(digest_size=32)
+
+
+class HashingWriter:
+    """File wrapper that feeds every written block into a hash."""
+
+    def __init__(self, f, file_hash):
+        self.f = f
+        self.file_hash = file_hash
+
+    def write(self, block):
+        self.file_hash.update(block)
+        return self.f.write(block)
+
+
+def update_checksum(file_hash, file_path):
+    """Feed the existing content of a file into a running hash."""
     with open(file_path, "rb") as f:
-        for byte_block in iter(lambda: f.read(4096), b""):
-            sha256_hash.update(byte_block)
-    return sha256_hash.hexdigest()
+        for byte_block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            file_hash.update(byte_block)
+
+
+_thread_local = threading.local()
+
+
+def get_session():
+    """Return the HTTP session of the current thread, creating it on first use."""
+    if not hasattr(_thread_local, "session"):
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _thread_local.session = session
+    return _thread_local.session
+
+
+FTP_POOL_SIZE = 4  # Idle FTP connections kept per host
+
+_ftp_pool = defaultdict(lambda: queue.LifoQueue(maxsize=FTP_POOL_SIZE))
+_ftp_lock = threading.Lock()
+
+
+def get_ftp(host):
+    """Check out a logged-in FTP connection to `host`, reusing an idle one if possible."""
+    with _ftp_lock:
+        pool = _ftp_pool[host]
+    while True:
+        try:
+            ftp = pool.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            ftp.voidcmd("NOOP")  # The server may have closed idle connections
+            return ftp
+        except ftplib.all_errors:
+            ftp.close()
+    ftp = ftplib.FTP(host)
+    ftp.login()
+    return ftp
+
+
+def put_ftp(host, ftp):
+    """Return a healthy FTP connection to the pool, closing it if the pool is full."""
+    with _ftp_lock:
+        pool = _ftp_pool[host]
+    try:
+        pool.put_nowait(ftp)
+    except queue.Full:
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+
+def close_ftp_pool():
+    """Log out of every pooled FTP connection."""
+    with _ftp_lock:
+        pools = list(_ftp_pool.values())
+    for pool in pools:
+        while not pool.empty():
+            ftp = pool.get_nowait()
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
 
 
 def generate_short_hash(url):
@@ -73,19 +176,20 @@ def download_file_with_resume(url, download_location, headers=None, timeout=30,
             headers.update({"Range": f"bytes={downloaded_bytes}-"})
 
         # Stream the download
-        with requests.get(url, headers=headers, timeout=timeout, stream=True, verify=verify) as response:
+        with get_session().get(url, headers=headers, timeout=timeout, stream=True, verify=verify) as response:
             if response.status_code in [200, 206]:  # 206: Partial Content
-                mode = "ab" if downloaded_bytes > 0 else "wb"
-                with open(temp_location, mode) as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            try:
-                                f.write(chunk)
-                            except IncompleteRead as ir:
-                                tqdm.write(f"IncompleteRead encountered: {ir}")
-                                raise
+                # The checksum is computed while writing, so the file is never read back.
+                # A 200 reply to a range request means the server restarted from byte 0.
+                file_hash = new_checksum()
+                resume = downloaded_bytes > 0 and response.status_code == 206
+                if resume:
+                    update_checksum(file_hash, temp_location)
+                # Copy straight from the socket in large blocks, decoding gzip/deflate if needed
+                response.raw.decode_content = True
+                with open(temp_location, "ab" if resume else "wb") as f:
+                    shutil.copyfileobj(response.raw, HashingWriter(f, file_hash), length=CHUNK_SIZE)
                 os.rename(temp_location, download_location)
-                return time.time() - start_time, response.status_code, calculate_checksum(download_location)
+                return time.time() - start_time, response.status_code, file_hash.hexdigest()
             else:
                 return time.time() - start_time, f"error: {response.status_code}", None
 
@@ -94,51 +198,103 @@ def download_file_with_resume(url, download_location, headers=None, timeout=30,
         return time.time() - start_time, f"error: {e}", None
 
 
-def fetch_url_content(url, download_location, log_writer):
-    """Download content from HTTP/HTTPS or FTP and log the result."""
+def make_log_row(url, start_time, end_time, status, download_location, checksum):
+    """Build a row for the download log."""
+    return {
+        "url": url,
+        "start_time": start_time,
+        "end_time": end_time,
+        "status": status,
+        "parameters": f"timeout={args.timeout}, verify={verify}, no_threads={args.no_threads}, checksum={CHECKSUM_ALGORITHM}",
+        "file_path": download_location,
+        "file_checksum": checksum,
+    }
+
+
+def fetch_url_content(url, download_location):
+    """Download content from HTTP/HTTPS or FTP and return the log row."""
     if not url:
-        return
+        return None
     start_time = time.time()
     try:
         if url.startswith("ftp://"):
             ftp_url = urlparse(url)
-            ftp = ftplib.FTP(ftp_url.netloc)
-            ftp.login()
-            ftp.cwd(os.path.dirname(ftp_url.path))
-            filename = ftp_url.path.split("/")[-1]
-            with open(download_location, "wb") as f:
-                ftp.retrbinary(f"RETR {filename}", f.write)
-            ftp.quit()
+            ftp = get_ftp(ftp_url.netloc)
+            try:
+                ftp.cwd(os.path.dirname(ftp_url.path))
+                filename = ftp_url.path.split("/")[-1]
+                file_hash = new_checksum()
+                with open(download_location, "wb") as f:
+                    ftp.retrbinary(f"RETR {filename}", HashingWriter(f, file_hash).write, blocksize=CHUNK_SIZE)
+            except Exception:
+                # Never return a connection in an unknown state to the pool
+                ftp.close()
+                raise
+            put_ftp(ftp_url.netloc, ftp)
             status = "ftp"
-            checksum = calculate_checksum(download_location)
+            checksum = file_hash.hexdigest()
         else:
             duration, status, checksum = download_file_with_resume(
                 url, download_location, timeout=args.timeout, verify=verify
             )
 
         end_time = time.time()
-        log_writer.writerow({
-            "url": url,
-            "start_time": int(start_time),
-            "end_time": int(end_time),
-            "status": status,
-            "parameters": f"timeout={args.timeout}, verify={verify}, no_threads={args.no_threads}",
-            "file_path": download_location,
-            "file_checksum": checksum,
-        })
+        return make_log_row(url, int(start_time), int(end_time), status, download_location, checksum)
 
     except Exception as e:
         end_time = time.time()
         tqdm.write(f"Error fetching URL {url}: {e}")
-        log_writer.writerow({
-            "url": url,
-            "start_time": start_time,
-            "end_time": end_time,
-            "status": f"error: {e}",
-            "parameters": f"timeout={args.timeout}, verify={verify}, no_threads={args.no_threads}",
-            "file_path": download_location,
-            "file_checksum": None,
-        })
+        return make_log_row(url, start_time, end_time, f"error: {e}", download_location, None)
+
+
+# ----------------------
+# Asynchronous downloads (--async)
+# ----------------------
+
+async def download_file_async(session, url, download_location):
+    """Download a file over HTTP(S) on the event loop, returning (status, checksum)."""
+    temp_location = f"{download_location}.part"
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=args.timeout, sock_read=args.timeout)
+    async with session.get(url, timeout=timeout, ssl=verify) as response:  # True verifies certificates, False skips it
+        if response.status != 200:
+            return f"error: {response.status}", None
+        file_hash = new_checksum()
+        async with aiofiles.open(temp_location, "wb") as f:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                file_hash.update(chunk)
+                await f.write(chunk)
+    os.replace(temp_location, download_location)
+    return response.status, file_hash.hexdigest()
+
+
+async def fetch_url_content_async(session, semaphore, url, download_location):
+    """Asynchronous counterpart of fetch_url_content; FTP downloads run on a worker thread."""
+    if not url:
+        return None
+    async with semaphore:
+        if url.startswith("ftp://"):
+            return await asyncio.to_thread(fetch_url_content, url, download_location)
+
+        start_time = time.time()
+        try:
+            status, checksum = await download_file_async(session, url, download_location)
+            return make_log_row(url, int(start_time), int(time.time()), status, download_location, checksum)
+        except Exception as e:
+            tqdm.write(f"Error fetching URL {url}: {e}")
+            return make_log_row(url, start_time, time.time(), f"error: {e}", download_location, None)
+
+
+async def download_all_async(jobs, log_writer, log_file):
+    """Run all downloads on one event loop, with at most `workers` in flight."""
+    semaphore = asyncio.Semaphore(workers)
+    connector = aiohttp.TCPConnector(limit=workers, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [fetch_url_content_async(session, semaphore, url, filename) for url, filename in jobs]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Downloading"):
+            log_row = await task
+            if log_row:
+                log_writer.writerow(log_row)
+                log_file.flush()
 
 
 # ----------------------
@@ -152,15 +308,17 @@ with open(args.file, "r") as f:
     for row in reader:
         urls.add(row["url"].strip())
 
+os.makedirs(args.output, exist_ok=True)
+
+# Files already in the output folder, read with a single directory scan
+with os.scandir(args.output) as it:
+    downloaded = {e.name for e in it if e.name.endswith(".zip")}
+
 # Retry mode: skip already downloaded files
 if args.retry_failed:
     print("Retrying only failed or missing downloads...")
     initial_count = len(urls)
-    for url in list(urls):
-        short_hash = generate_short_hash(url)
-        filename = os.path.join(args.output, f"{short_hash}.zip")
-        if os.path.exists(filename):
-            urls.discard(url)
+    urls = {url for url in urls if f"{generate_short_hash(url)}.zip" not in downloaded}
     print(f"Skipped {initial_count - len(urls)} URLs already downloaded.")
 
 # Setup
@@ -168,11 +326,16 @@ verify = not args.no_verify
 if not verify:
     urllib3.disable_warnings()
 
-os.makedirs(args.output, exist_ok=True)
-threads = []
-file_exists = os.path.isfile(args.logging_file)
+workers = 1 if args.no_threads else args.workers
+
+print(f"Starting downloads: timeout={args.timeout}, verify={verify}, workers={workers}")
 
-print(f"Starting downloads: timeout={args.timeout}, verify={verify}, threading={not args.no_threads}")
+# Skip files that already exist
+jobs = []
+for url in urls:
+    filename = f"{generate_short_hash(url)}.zip"
+    if filename not in downloaded:
+        jobs.append((url, os.path.join(args.output, filename)))
 
 # Open logging file
 with open(args.logging_file, "a", newline="") as log_file:
@@ -180,29 +343,24 @@ with open(args.logging_file, "a", newline="") as log_file:
         "url", "start_time", "end_time", "status",
         "parameters", "file_path", "file_checksum"
     ])
-    if not file_exists:
+    # In append mode the file position starts at the end, so 0 means a new or empty log
+    if log_file.tell() == 0:
         log_writer.writeheader()
 
-    if args.no_threads:
-        # Sequential downloading
-        for url in tqdm(urls, desc="Downloading"):
-            short_hash = generate_short_hash(url)
-            filename = os.path.join(args.output, f"{short_hash}.zip")
-            if os.path.exists(filename):
-                continue
-            fetch_url_content(url, filename, log_writer)
+    if args.use_async:
+        run = uvloop.run if uvloop is not None else asyncio.run
+        run(download_all_async(jobs, log_writer, log_file))
     else:
-        # Multi-threaded downloading
-        for url in tqdm(urls, desc="Queueing"):
-            short_hash = generate_short_hash(url)
-            filename = os.path.join(args.output, f"{short_hash}.zip")
-            if os.path.exists(filename):
-                continue
-            thread = threading.Thread(target=fetch_url_content, args=(url, filename, log_writer))
-            threads.append(thread)
-            thread.start()
-
-        for thread in tqdm(threads, desc="Waiting for threads"):
-            thread.join()
+        # Bounded pool: at most `workers` downloads run at the same time.
+        # Log rows are written from the main thread only, so the writer is never shared.
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fetch_url_content, url, filename) for url, filename in jobs]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading"):
+                log_row = future.result()
+                if log_row:
+                    log_writer.writerow(log_row)
+                    log_file.flush()
+
+close_ftp_pool()
 
 print(f"Finished processing {len(urls)} URLs.")
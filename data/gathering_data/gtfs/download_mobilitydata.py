@@ -1,4 +1,6 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 import argparse
 import time
@@ -6,6 +8,7 @@ import json
 import dotenv
 import os
 import csv
+from concurrent.futures import ThreadPoolExecutor
 
 # Load environment variables from a .env file
 dotenv.load_dotenv()
@@ -40,13 +43,33 @@ parser.add_argument(
     '--limit', type=int, default=100,
     help='Number of feeds to request per API call (default: 100)'
 )
+parser.add_argument(
+    '--workers', type=int, default=8,
+    help='Number of countries to scrape concurrently (default: 8)'
+)
+parser.add_argument(
+    '--keep-raw', type=str, default=None,
+    help='Also save the raw feed objects to this JSON lines file (for debugging)'
+)
 args = parser.parse_args()
 
+# Run metadata, identical for every row logged by this run
+RUN_ID = f'mobilitydata_{time.strftime("%Y%m%d")}'
+RUN_TS = int(time.time())
+
+# Shared HTTP session: keeps connections (and TLS sessions) alive between requests
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
 # ----------------------
 # Authenticate to MobilityDatabase API
 # ----------------------
 auth_payload = {'refresh_token': REFRESH_TOKEN}
-auth_response = requests.post(
+auth_response = session.post(
     'https://api.mobilitydatabase.org/v1/tokens',
     headers={'Content-Type': 'application/json'},
     json=auth_payload
@@ -58,76 +81,106 @@ mobility_headers = {
     'Authorization': f'Bearer {access_token}',
 }
 
+
+# ----------------------
+# Fetch all feeds of a country
+# ----------------------
+def scrape_country(country):
+    """Return all active feeds for a country, following offset pagination.
+
+    Feeds are reduced to (id, url, license, status) tuples as pages arrive;
+    the raw feed objects are only returned as well when --keep-raw is set.
+    """
+    country_feeds = []
+    raw_feeds = []
+    offset = 0
+
+    while True:
+        params = {
+            'limit': args.limit,
+            'offset': offset,
+            'country_code': country,
+            'status': 'active',
+        }
+
+        feeds_response = session.get(
+            'https://api.mobilitydatabase.org/v1/gtfs_feeds',
+            headers=mobility_headers,
+            params=params
+        )
+
+        try:
+            feeds = feeds_response.json()
+            assert feeds_response.status_code == 200
+        except Exception as e:
+            if VERBOSE:
+                tqdm.write(f"Error retrieving feeds for {country}: {e}")
+                tqdm.write(f"Response: {feeds_response.text}")
+            break  # Skip to the next country
+
+        for feed in feeds:
+            source_info = feed['source_info']
+            country_feeds.append((
+                feed['id'],
+                source_info.get('producer_url', '').strip(),
+                source_info.get('license_url', ''),
+                feed.get('status', '')
+            ))
+        if args.keep_raw:
+            raw_feeds.extend(feeds)
+
+        # Stop fetching if fewer feeds than the limit were returned
+        if len(feeds) < args.limit:
+            break
+
+        offset += args.limit
+
+    return country_feeds, raw_feeds
+
+
 # ----------------------
 # Setup logging CSV
 # ----------------------
-file_exists = os.path.isfile(args.logging_file)
 fieldnames = [
     'url', 'run_id', 'time_added', 'source',
     'id', 'country', 'license', 'known_status'
 ]
-all_feeds = []
+seen_ids = set()
+
+raw_file = open(args.keep_raw, 'w') if args.keep_raw else None
 
 with open(args.logging_file, 'a', newline='') as csvfile:
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    if not file_exists:
-        writer.writeheader()
-
-    for country in tqdm(args.countries, desc='Countries', position=0, disable=not VERBOSE):
-        offset = 0
-        keep_fetching = True
-
-        while keep_fetching:
-            params = {
-                'limit': args.limit,
-                'offset': offset,
-                'country_code': country,
-                'status': 'active',
-            }
-
-            feeds_response = requests.get(
-                'https://api.mobilitydatabase.org/v1/gtfs_feeds',
-                headers=mobility_headers,
-                params=params
-            )
-
-            try:
-                feeds = feeds_response.json()
-                assert feeds_response.status_code == 200
-            except Exception as e:
-                if VERBOSE:
-                    tqdm.write(f"Error retrieving feeds: {e}")
-                    tqdm.write(f"Response: {feeds_response.text}")
-                break  # Skip to the next country
-
-            for feed in tqdm(feeds, desc=f'Feeds {country} ({offset})', position=1, leave=False):
-                if not any(existing['id'] == feed['id'] for existing in all_feeds):
-                    all_feeds.append(feed)
-                    url = feed['source_info'].get('producer_url', '').strip()
+    writer = csv.writer(csvfile)
+    if csvfile.tell() == 0:
+        writer.writerow(fieldnames)
+
+    # Countries are fetched concurrently; rows are written from the main thread only
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        results = executor.map(scrape_country, args.countries)
+        for country, (feeds, raw_feeds) in tqdm(zip(args.countries, results), total=len(args.countries),
+                                                desc='Countries', disable=not VERBOSE):
+            rows = []
+            for feed_id, url, license_url, status in feeds:
+                if feed_id not in seen_ids:
+                    seen_ids.add(feed_id)
                     if url:
-                        writer.writerow({
-                            'url': url,
-                            'run_id': f'mobilitydata_{time.strftime("%Y%m%d")}',
-                            'time_added': int(time.time()),
-                            'source': 'mobilitydatabase',
-                            'id': feed['id'],
-                            'country': country,
-                            'license': feed['source_info'].get('license_url', ''),
-                            'known_status': feed.get('status', '')
-                        })
+                        # Same column order as `fieldnames`
+                        rows.append((url, RUN_ID, RUN_TS, 'mobilitydatabase', feed_id, country, license_url, status))
                 elif VERBOSE:
-                    tqdm.write(f"Feed {feed['id']} already processed.")
+                    tqdm.write(f"Feed {feed_id} already processed.")
+            writer.writerows(rows)
 
-            # Stop fetching if fewer feeds than the limit were returned
-            if len(feeds) < args.limit:
-                keep_fetching = False
+            if raw_file:
+                for feed in raw_feeds:
+                    raw_file.write(json.dumps(feed) + '\n')
 
-            offset += args.limit
+if raw_file:
+    raw_file.close()
 
 # ----------------------
 # Final summary
 # ----------------------
 if VERBOSE:
-    print(f"Finished scraping feeds. Total feeds collected: {len(all_feeds)}")
+    print(f"Finished scraping feeds. Total feeds collected: {len(seen_ids)}")
 
 print(args.logging_file)
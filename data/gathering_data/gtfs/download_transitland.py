@@ -1,4 +1,6 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
 from tqdm import tqdm
 from urllib.parse import urljoin
@@ -6,6 +8,8 @@ import time
 import dotenv
 import os
 import csv
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Load API key from .env file
 dotenv.load_dotenv()
@@ -38,9 +42,33 @@ parser.add_argument(
     '--countries', nargs='+', default=DEFAULT_COUNTRIES,
     help='List of country codes to scrape (default: broad European region)'
 )
+parser.add_argument(
+    '--workers', type=int, default=8,
+    help='Number of countries to scrape concurrently (default: 8)'
+)
 args = parser.parse_args()
 
+# Run metadata, identical for every row logged by this run
+RUN_ID = f'transitland_{time.strftime("%Y%m%d")}'
+RUN_TS = int(time.time())
+
+# Shared HTTP session: keeps connections (and TLS sessions) alive between requests.
+# Rate limits (429) are retried with exponential backoff, waiting for Retry-After when the API sends it.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=1,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+    ),
+))
+
 requests_number = 0  # Track number of API requests made
+seen_onestop_ids = set()
+state_lock = threading.Lock()  # Guards requests_number and seen_onestop_ids across workers
 
 
 # ----------------------
@@ -57,8 +85,9 @@ def get_onestop_ids(country, limit=100):
 
     keep_going = True
     while keep_going:
-        response = requests.get(urljoin(BASE_URL, 'agencies'), params=params)
-        requests_number += 1
+        response = session.get(urljoin(BASE_URL, 'agencies'), params=params)
+        with state_lock:
+            requests_number += 1
 
         if not response.ok:
             tqdm.write(f"Failed to fetch agencies for {country} (status: {response.status_code})")
@@ -82,83 +111,123 @@ def get_onestop_ids(country, limit=100):
 
 
 # ----------------------
-# Prepare CSV logging
+# Get all feeds in a few paginated requests
 # ----------------------
-file_exists = os.path.isfile(args.logging_file)
-seen_onestop_ids = set()
+def get_all_feeds(limit=100):
+    """Return every feed listed by Transitland, keyed by onestop_id."""
+    global requests_number
+    feeds_by_onestop = {}
+    params = {
+        'apikey': API_KEY,
+        'limit': limit
+    }
 
-with open(args.logging_file, 'a', newline='') as csvfile:
-    fieldnames = [
-        'url', 'run_id', 'time_added', 'source',
-        'id', 'country', 'license', 'known_status'
-    ]
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+    keep_going = True
+    while keep_going:
+        response = session.get(urljoin(BASE_URL, 'feeds'), params=params)
+        with state_lock:
+            requests_number += 1
 
-    if not file_exists:
-        writer.writeheader()
+        if not response.ok:
+            tqdm.write(f"Failed to fetch feed listing (status: {response.status_code})")
+            break
+
+        data = response.json()
+        for feed in data.get('feeds', []):
+            feeds_by_onestop[feed['onestop_id']] = feed
+
+        # Handle pagination
+        if 'meta' in data and 'after' in data['meta']:
+            params['after'] = data['meta']['after']
+        else:
+            keep_going = False
+
+    return feeds_by_onestop
 
-    # ----------------------
-    # Iterate by country
-    # ----------------------
-    for country in tqdm(args.countries, desc='Countries', disable=not VERBOSE, position=0):
-        onestop_ids = get_onestop_ids(country)
 
-        # ----------------------
-        # Iterate over feeds (onestop_ids)
-        # ----------------------
-        for onestop_id in tqdm(onestop_ids, desc=f'Feeds for {country}', disable=not VERBOSE, position=1, leave=False):
+# ----------------------
+# Get a single feed (fallback for feeds missing from the listing)
+# ----------------------
+def get_feed(onestop_id):
+    global requests_number
+    params = {
+        'onestop_id': onestop_id,
+        'apikey': API_KEY
+    }
+
+    # Request feed metadata
+    response = session.get(urljoin(BASE_URL, 'feeds'), params=params)
+    response.raise_for_status()
+    with state_lock:
+        requests_number += 1
+
+    feeds = response.json().get('feeds', [])
+    # Use first feed (even if multiple versions exist)
+    return feeds[0] if feeds else None
+
+
+# ----------------------
+# Build the rows for a country
+# ----------------------
+def scrape_country(country):
+    """Return the CSV rows for all not yet seen feeds of a country."""
+    rows = []
+    onestop_ids = get_onestop_ids(country)
+
+    for onestop_id in onestop_ids:
+        with state_lock:
             if onestop_id in seen_onestop_ids:
                 continue
             seen_onestop_ids.add(onestop_id)
 
-            try:
-                params = {
-                    'onestop_id': onestop_id,
-                    'apikey': API_KEY
-                }
-
-                # Request feed metadata
-                response = requests.get(urljoin(BASE_URL, 'feeds'), params=params)
-
-                if response.status_code == 429:  # Rate limit
-                    if VERBOSE:
-                        tqdm.write("Rate limit hit. Waiting 60 seconds...")
-                    time.sleep(60)
-                    response = requests.get(urljoin(BASE_URL, 'feeds'), params=params)
-
-                response.raise_for_status()
-                requests_number += 1
-
-                feeds = response.json().get('feeds', [])
-                if not feeds:
-                    if VERBOSE:
-                        tqdm.write(f"No feeds found for {onestop_id}")
-                    continue
-
-                # Log first feed (even if multiple versions exist)
-                feed = feeds[0]
-                url = feed.get('urls', {}).get('static_current', '')
-                license_info = feed.get('license', '')
-                feed_state = feed.get('feed_state', {})
-                status = feed_state.get('feed_version', {}).get('feed_version_gtfs_import', {}).get('success', '')
-                known_status = 'active' if status else 'inactive'
-
-                writer.writerow({
-                    'url': url,
-                    'run_id': f'transitland_{time.strftime("%Y%m%d")}',
-                    'time_added': int(time.time()),
-                    'source': 'transitland',
-                    'id': onestop_id,
-                    'country': country,
-                    'license': license_info,
-                    'known_status': known_status
-                })
-
-            except Exception as e:
+        try:
+            feed = feeds_by_onestop.get(onestop_id) or get_feed(onestop_id)
+            if not feed:
                 if VERBOSE:
-                    tqdm.write(f"Error processing {onestop_id}: {e}")
+                    tqdm.write(f"No feeds found for {onestop_id}")
                 continue
 
+            url = feed.get('urls', {}).get('static_current', '')
+            license_info = feed.get('license', '')
+            feed_state = feed.get('feed_state', {})
+            status = feed_state.get('feed_version', {}).get('feed_version_gtfs_import', {}).get('success', '')
+            known_status = 'active' if status else 'inactive'
+
+            # Same column order as `fieldnames`
+            rows.append((url, RUN_ID, RUN_TS, 'transitland', onestop_id, country, license_info, known_status))
+
+        except Exception as e:
+            if VERBOSE:
+                tqdm.write(f"Error processing {onestop_id}: {e}")
+            continue
+
+    return rows
+
+
+# ----------------------
+# Prepare CSV logging
+# ----------------------
+with open(args.logging_file, 'a', newline='') as csvfile:
+    fieldnames = [
+        'url', 'run_id', 'time_added', 'source',
+        'id', 'country', 'license', 'known_status'
+    ]
+    writer = csv.writer(csvfile)
+
+    if csvfile.tell() == 0:
+        writer.writerow(fieldnames)
+
+    # Feed metadata is fetched once and joined locally with each country's agencies
+    feeds_by_onestop = get_all_feeds()
+
+    # ----------------------
+    # Iterate by country (concurrently), writing rows from the main thread
+    # ----------------------
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for rows in tqdm(executor.map(scrape_country, args.countries), total=len(args.countries),
+                         desc='Countries', disable=not VERBOSE):
+            writer.writerows(rows)
+
 # ----------------------
 # Summary
 # ----------------------
@@ -1,7 +1,7 @@
 import os
 import argparse
 import csv
-import json
+import orjson
 import time
 from tqdm import tqdm
 
@@ -22,45 +22,50 @@ parser.add_argument('--countries', nargs='+', help='Countries to scrape (country
 parser.add_argument('--transitous_path', type=str, required=True, help='Path to the Transitous git repository')
 args = parser.parse_args()
 
+# Run metadata, identical for every row logged by this run
+RUN_ID = f'transitous_{time.strftime("%Y%m%d")}'
+RUN_TS = int(time.time())
+# Constant columns of each row, around the variable url/id/country values
+ROW_RUN_INFO = (RUN_ID, RUN_TS, 'transitous')
+ROW_SUFFIX = (None, None)  # license, known_status
+
 
 feeds_path = os.path.join(args.transitous_path, 'feeds')
-json_files = [f for f in os.listdir(feeds_path) if f.endswith('.json')]
+wanted = frozenset(country.upper() for country in args.countries)
+# Only keep feed files of the requested countries, so other files are never opened
+with os.scandir(feeds_path) as it:
+    json_files = [
+        e.name for e in it
+        if e.is_file() and e.name.endswith('.json') and e.name.split('.')[0].upper() in wanted
+    ]
 
-file_exists = os.path.isfile(args.logging_file)
 transitland_ids = set()
 
 with open(args.logging_file, 'a', newline='') as csvfile:
     fieldnames = ['url', 'run_id', 'time_added', 'source', 'id', 'country', 'license', 'known_status']
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-    
-    if not file_exists:
-        writer.writeheader()
+    writer = csv.writer(csvfile)
+
+    if csvfile.tell() == 0:
+        writer.writerow(fieldnames)
 
     for file in tqdm(json_files, desc='Files', position=0):
         country_code = file.split('.')[0].upper()
-        if country_code in args.countries:
-            filepath = os.path.join(feeds_path, file)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            except Exception as e:
-                print(f"Error loading JSON from {file}: {e}")
-                continue
+        filepath = os.path.join(feeds_path, file)
+        try:
+            with open(filepath, 'rb') as f:
+                data = orjson.loads(f.read())
+        except Exception as e:
+            print(f"Error loading JSON from {file}: {e}")
+            continue
 
-            for s in data.get('sources', []):
-                if s.get('type') == 'http' and s.get('spec') != 'gtfs-rt':
-                    writer.writerow({
-                        'url': s['url'],
-                        'run_id': f'transitous_{time.strftime("%Y%m%d")}',
-                        'time_added': int(time.time()),
-                        'source': 'transitous',
-                        'id': s.get('name', ''),
-                        'country': country_code,
-                        'license': None,
-                        'known_status': None,
-                    })
-                elif s.get('type') == 'transitland-atlas':
-                    transitland_ids.add(s.get('transitland-atlas-id'))
+        rows = []
+        for s in data.get('sources', []):
+            if s.get('type') == 'http' and s.get('spec') != 'gtfs-rt':
+                # Same column order as `fieldnames`
+                rows.append((s['url'],) + ROW_RUN_INFO + (s.get('name', ''), country_code) + ROW_SUFFIX)
+            elif s.get('type') == 'transitland-atlas':
+                transitland_ids.add(s.get('transitland-atlas-id'))
+        writer.writerows(rows)
 
 # -------------------------------
 # Write Transitland IDs to file
@@ -1,31 +1,37 @@
 import os
-import csv
+import re
+import sys
 import zipfile
+import asyncio
 import logging
 import argparse
-import requests
+import aiohttp
 import subprocess
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
-from io import TextIOWrapper
-from scipy.spatial import cKDTree
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
-import concurrent.futures
+from sklearn.neighbors import BallTree
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.contrib.logging import logging_redirect_tqdm
 
 # ----------------------------- #
 #         Overpass Query        #
 # ----------------------------- #
-def overpass_query(lat, lon, distance=1000):
+def overpass_query(locations, distance=1000):
     """
-    Create Overpass QL query to extract highways and platforms within a distance.
+    Create Overpass QL query to extract highways and platforms within a distance
+    of any of the given (lon, lat) locations.
     """
-    return f"""
-    [out:xml][timeout:600];
-    (
+    clauses = "".join(
+        f"""
         way["highway"](around:{distance},{lat},{lon});
         way["public_transport"="platform"](around:{distance},{lat},{lon});
-        way["railway"="platform"](around:{distance},{lat},{lon});
+        way["railway"="platform"](around:{distance},{lat},{lon});"""
+        for lon, lat in locations
+    )
+    return f"""
+    [out:xml][timeout:600];
+    ({clauses}
     );
     (._;>;);
     out meta;
@@ -34,76 +40,137 @@ def overpass_query(lat, lon, distance=1000):
 # ----------------------------- #
 #     Fetch and Convert OSM    #
 # ----------------------------- #
-def fetch_osm_data(station_id, lat, lon, distance=1000, skip_existing=False):
+async def fetch_osm_data(session, semaphore, batch_id, locations, distance=1000, overwrite=True, skip_existing=False):
     """
-    Downloads OSM XML data from Overpass API for a given location.
+    Downloads OSM data from Overpass API around a batch of locations, using a
+    single request for the whole batch, and streams it into Osmium to write
+    .osm.pbf directly without an intermediate XML file.
     """
-    try:
-        osm_file = os.path.join(OUTPUT_FOLDER, f"station_{station_id}.osm")
-        if skip_existing and (os.path.exists(osm_file) or os.path.exists(osm_file.replace(".osm", ".osm.pbf"))):
-            logging.info(f"Skipping station {station_id}; file exists.")
-            return osm_file
-
-        query = overpass_query(lat, lon, distance)
-        response = requests.post(OVERPASS_URL, data=query, timeout=60)
-        response.raise_for_status()
-
-        with open(osm_file, "wb") as f:
-            f.write(response.content)
-        logging.info(f"Fetched OSM for station {station_id}")
-        return osm_file
-
-    except requests.RequestException as e:
-        logging.error(f"Failed to fetch station {station_id} ({lat}, {lon}): {e}")
-        return None
+    pbf_file = os.path.join(OUTPUT_FOLDER, f"batch_{batch_id}.osm.pbf")
+    if skip_existing and os.path.exists(pbf_file):
+        logging.info(f"Skipping batch {batch_id}; file exists.")
+        return pbf_file
 
-def convert_osm_to_pbf(osm_file, overwrite=True, skip_existing=False):
-    """
-    Converts .osm XML file to .osm.pbf format using Osmium tool.
-    """
     try:
-        pbf_file = osm_file.replace(".osm", ".osm.pbf")
-        if skip_existing and os.path.exists(pbf_file):
-            logging.info(f"PBF already exists, skipping: {pbf_file}")
-            return pbf_file
+        query = overpass_query(locations, distance)
+        async with semaphore:
+            async with session.post(OVERPASS_URL, data=query) as response:
+                response.raise_for_status()
 
-        command = ["osmium", "cat", osm_file, "-o", pbf_file]
-        if overwrite:
-            command.append("--overwrite")
+                command = ["osmium", "cat", "-", "-F", "osm", "-o", pbf_file, "-f", "osm.pbf"]
+                if overwrite:
+                    command.append("--overwrite")
 
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        logging.info(f"Converted to PBF: {pbf_file}")
-        os.remove(osm_file)
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                )
+                try:
+                    async for chunk in response.content.iter_chunked(1024 * 1024):
+                        process.stdin.write(chunk)
+                        await process.stdin.drain()
+                finally:
+                    process.stdin.close()
+                    returncode = await process.wait()
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
+        logging.info(f"Fetched OSM for batch {batch_id} ({len(locations)} stations): {pbf_file}")
         return pbf_file
 
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Conversion failed for {osm_file}: {e}")
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.error(f"Failed to fetch batch {batch_id} ({len(locations)} stations): {e}")
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.error(f"Conversion failed for batch {batch_id}: {e}")
+
+    # Do not leave a truncated PBF behind for --skip-existing to pick up
+    if os.path.exists(pbf_file):
+        os.remove(pbf_file)
+    return None
+
+async def process_batch(session, semaphore, batch_id, locations, distance=1000, skip_existing=False):
+    """
+    Fetch and convert OSM data for a batch of stations.
+    """
+    try:
+        result = await fetch_osm_data(session, semaphore, batch_id, locations, distance, skip_existing=skip_existing)
+        if result:
+            logging.info(f"Batch {batch_id} processed.")
+        else:
+            logging.warning(f"Batch {batch_id} failed.")
+        return result
+    except Exception as e:
+        logging.error(f"Error for batch {batch_id} ({len(locations)} stations): {e}")
         return None
 
-def process_station(station_id, lat, lon, distance=1000, skip_existing=False):
+async def get_overpass_slots(session):
     """
-    Fetch and convert OSM data for a single station.
+    Read the number of concurrent query slots granted by the Overpass server,
+    or None if the status endpoint does not report it.
     """
-    osm_file = fetch_osm_data(station_id, lat, lon, distance, skip_existing)
-    if osm_file:
-        return convert_osm_to_pbf(osm_file, skip_existing=skip_existing)
-    return None
+    status_url = OVERPASS_URL.rsplit("/", 1)[0] + "/status"
+    try:
+        async with session.get(status_url) as response:
+            response.raise_for_status()
+            match = re.search(r"Rate limit: (\d+)", await response.text())
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warning(f"Could not read Overpass status: {e}")
+        return None
+    # A rate limit of 0 means the server does not limit slots
+    return (int(match.group(1)) or None) if match else None
+
+async def process_all_batches(batches, distance=1000, max_workers=10, skip_existing=False):
+    """
+    Fetch all batches concurrently, never running more requests at once than
+    `max_workers` or the slots the Overpass server allows.
+    """
+    timeout = aiohttp.ClientTimeout(total=600)  # Same as the server-side [timeout:600]
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        slots = await get_overpass_slots(session)
+        if slots and slots < max_workers:
+            logging.info(f"Overpass allows {slots} concurrent queries; limiting to {slots}.")
+            max_workers = slots
+        semaphore = asyncio.Semaphore(max(1, max_workers))
+
+        tasks = [
+            process_batch(session, semaphore, i + 1, batch, distance, skip_existing)
+            for i, batch in enumerate(batches)
+        ]
+        for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Processing station batches"):
+            await task
 
 # ----------------------------- #
 #         GTFS Parsing         #
 # ----------------------------- #
 def get_locations(zip_file_path):
     """
-    Extract (lon, lat) stop coordinates from GTFS stops.txt in a ZIP archive.
+    Extract (lon, lat) stop coordinates from GTFS stops.txt in a ZIP archive,
+    as an (N, 2) float32 array.
     """
     with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
         with zip_ref.open('stops.txt') as file:
-            reader = csv.DictReader(TextIOWrapper(file))
-            return {(float(row['stop_lon']), float(row['stop_lat'])) for row in reader}
+            df = pd.read_csv(file, usecols=['stop_lon', 'stop_lat'], dtype=np.float32)
+            return df[['stop_lon', 'stop_lat']].to_numpy()
 
 # ----------------------------- #
 #      Spatial De-duplication  #
 # ----------------------------- #
+def unique_grid_cells(points, radius=1000):
+    """
+    Keeps one (lon, lat) point per grid cell small enough that any two points
+    in the same cell are within `radius` meters of each other.
+    Points are returned ordered by cell, so nearby points stay together.
+    """
+    points = points[np.isfinite(points).all(axis=1)]
+
+    # Cell diagonal <= radius, using the length of a degree of latitude (a degree of longitude is never longer)
+    cell_size = radius / np.sqrt(2) / 111320
+    lon_idx = np.floor((points[:, 0].astype(np.float64) + 180) / cell_size).astype(np.uint64)
+    lat_idx = np.floor((points[:, 1].astype(np.float64) + 90) / cell_size).astype(np.uint64)
+    keys = (lat_idx << np.uint64(32)) | lon_idx
+
+    _, first_idx = np.unique(keys, return_index=True)
+    return points[first_idx]
+
 def filter_points_within_radius(points, radius=1000):
     """
     Filters out points that are within `radius` meters of another.
@@ -112,33 +179,36 @@ def filter_points_within_radius(points, radius=1000):
     if len(points) <= 1:
         return points
 
-    def to_cartesian(lon, lat):
-        lat, lon = np.radians(lat), np.radians(lon)
-        x = np.cos(lat) * np.cos(lon)
-        y = np.cos(lat) * np.sin(lon)
-        z = np.sin(lat)
-        return x, y, z
-
-    cartesian_points = np.array([to_cartesian(lon, lat) for lon, lat in points])
-    tree = cKDTree(cartesian_points)
+    # Great-circle distances directly on (lat, lon) in radians
+    coords = np.radians(np.asarray(points, dtype=np.float64)[:, ::-1])
+    tree = BallTree(coords, metric='haversine', leaf_size=40)
     angular_radius = radius / 6371000  # Earth radius in meters
-    neighbors = tree.query_ball_tree(tree, angular_radius)
-    
-    return neighbors
+    neighbors = tree.query_radius(coords, r=angular_radius)
+
+    # Visit points in order: each kept point removes all of its later neighbours
+    keep = np.ones(len(points), dtype=bool)
+    for i, neighbors_idx in enumerate(neighbors):
+        if keep[i]:
+            keep[neighbors_idx[neighbors_idx > i]] = False
+
+    return [points[k] for k in np.flatnonzero(keep)]
 
 # ----------------------------- #
 #     Merge All PBF Outputs    #
 # ----------------------------- #
-def merge_pbf_files(output_folder, final_output, overwrite=True):
+def merge_pbf_files(output_folder, final_output, overwrite=True, fast_concat=False):
     """
     Merge all .osm.pbf files into a single combined output.
+    Batches overlap, so osmium merge sorts them and drops objects present in several files,
+    unless `fast_concat` is set, in which case they are concatenated as-is (faster, but
+    the output is unsorted and has repeated objects).
     """
     try:
         pbf_files = [os.path.join(output_folder, f) for f in os.listdir(output_folder) if f.endswith(".pbf")]
         if not pbf_files:
             logging.warning("No PBF files to merge.")
             return
-        command = ["osmium", "merge", *pbf_files, "-o", final_output]
+        command = ["osmium", "cat" if fast_concat else "merge", *pbf_files, "-o", final_output]
         if overwrite:
             command.append("--overwrite")
 
@@ -157,9 +227,11 @@ if __name__ == "__main__":
     parser.add_argument("--output", default="combined.osm.pbf", help="Name of final merged output file")
     parser.add_argument("--output_folder", default="osm_data", help="Folder to store intermediate OSM/PBF files")
     parser.add_argument("--logging", default="INFO", help="Logging level (DEBUG, INFO, WARNING, etc.)")
-    parser.add_argument("--parallel", type=int, default=10, help="Number of parallel threads")
+    parser.add_argument("--parallel", type=int, default=10, help="Maximum number of concurrent Overpass requests")
     parser.add_argument("--distance", type=int, default=1000, help="Radius from station in meters")
     parser.add_argument("--skip-existing", action="store_true", help="Skip already processed files")
+    parser.add_argument("--batch-size", type=int, default=32, help="Number of stations per Overpass request")
+    parser.add_argument("--fast-concat", action="store_true", help="Concatenate the batches with osmium cat instead of merging them (faster, but leaves duplicate objects unsorted)")
     args = parser.parse_args()
 
     # Configuration
@@ -169,6 +241,7 @@ if __name__ == "__main__":
     OVERPASS_URL = "http://overpass-api.de/api/interpreter"
     MAX_WORKERS = args.parallel
     DISTANCE = args.distance
+    BATCH_SIZE = max(1, args.batch_size)
 
     # Setup
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
@@ -176,47 +249,34 @@ if __name__ == "__main__":
 
     # Extract GTFS stop coordinates
     gtfs_files = os.listdir(DATA_DIR)
-    all_locations = set()
+    location_arrays = []
 
-    with ProcessPoolExecutor() as executor:
+    # Decompression and pandas parsing release the GIL, and arrays need no pickling between threads
+    with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2)) as executor:
         futures = [executor.submit(get_locations, os.path.join(DATA_DIR, zip_file)) for zip_file in gtfs_files]
         for future in tqdm(futures, desc='Extracting GTFS stop locations'):
-            all_locations.update(future.result())
+            location_arrays.append(future.result())
 
-    # Remove close-by duplicates
-    points = list(all_locations)
-    neighbors = filter_points_within_radius(points, radius=(DISTANCE / 2))
-    visited = set()
+    # np.vstack raises on an empty list, and an empty tree cannot be queried
+    if sum(len(locations) for locations in location_arrays) == 0:
+        logging.critical(f"No GTFS stops found in {DATA_DIR}; nothing to download.")
+        sys.exit(1)
 
-    for neighbors_list in tqdm(neighbors, desc=f'Filtering duplicates <{DISTANCE/2}m'):
-        if neighbors_list[0] in visited:
-            continue
-        for idx in neighbors_list[1:]:
-            lon, lat = points[idx]
-            all_locations.discard((lon, lat))
-            visited.add(idx)
+    # Remove exact and close-by duplicates: hashing grid cells first leaves far fewer points
+    # for the tree, which then only has to resolve neighbours across cell boundaries
+    all_locations = unique_grid_cells(np.vstack(location_arrays), radius=(DISTANCE / 2))
+    logging.info(f"Filtering duplicates <{DISTANCE/2}m")
+    all_locations = filter_points_within_radius(all_locations, radius=(DISTANCE / 2))
+
+    # Group stations so that each Overpass request covers several of them
+    batches = [all_locations[i:i + BATCH_SIZE] for i in range(0, len(all_locations), BATCH_SIZE)]
 
     # Fetch and convert OSM data
     with logging_redirect_tqdm():
         try:
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-                futures = {
-                    executor.submit(process_station, i + 1, lat, lon, DISTANCE, args.skip_existing): (i + 1, lat, lon)
-                    for i, (lon, lat) in enumerate(all_locations)
-                }
-
-                for future in tqdm(concurrent.futures.as_completed(futures), total=len(all_locations), desc="Processing stations"):
-                    station_id, lat, lon = futures[future]
-                    try:
-                        result = future.result()
-                        if result:
-                            logging.info(f"Station {station_id} processed.")
-                        else:
-                            logging.warning(f"Station {station_id} failed.")
-                    except Exception as e:
-                        logging.error(f"Error for station {station_id} ({lat}, {lon}): {e}")
-
-            merge_pbf_files(OUTPUT_FOLDER, FINAL_OUTPUT)
+            asyncio.run(process_all_batches(batches, DISTANCE, MAX_WORKERS, args.skip_existing))
+
+            merge_pbf_files(OUTPUT_FOLDER, FINAL_OUTPUT, fast_concat=args.fast_concat)
 
         except Exception as e:
             logging.critical(f"Fatal error: {e}")
@@ -1,20 +1,23 @@
 import argparse
+import shutil
 import requests
 
+# Shared session: keep-alive across queries, compressed transfer of the (highly compressible) CSV results
+session = requests.Session()
+session.headers.update({"Accept-Encoding": "gzip, deflate", "Accept": "text/csv"})
+
 def download_sparql_results(query_file: str, output_file: str, endpoint_url: str = "https://data-interop.era.europa.eu/api/sparql"):
     with open(query_file, "r", encoding="utf-8") as f:
         query = f.read()
 
     params = {"query": query, "format": "csv"}
-    headers = {"Accept": "text/csv"}
-
-    response = requests.get(endpoint_url, params=params, headers=headers, stream=True)
-    response.raise_for_status()
 
-    with open(output_file, "wb") as f:
-        for chunk in response.iter_content(chunk_size=1024 * 1024):
-            if chunk:
-                f.write(chunk)
+    with session.get(endpoint_url, params=params, stream=True) as response:
+        response.raise_for_status()
+        # Decompress on the fly and copy in large blocks without a Python-level chunk loop
+        response.raw.decode_content = True
+        with open(output_file, "wb") as f:
+            shutil.copyfileobj(response.raw, f, length=1024 * 1024)
 
     print(f"Saved to {output_file}")
 
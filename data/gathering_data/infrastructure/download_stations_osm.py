@@ -1,5 +1,8 @@
-import overpy
+import re
+import sys
 import csv
+import requests
+from urllib3.util.retry import Retry
 import argparse
 from tqdm import tqdm
 import concurrent.futures
@@ -27,57 +30,99 @@ def get_train_stations_query(country_code):
     out body;
     """
 
-# Initialize Overpy API
-api = overpy.Overpass()
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
 
-# Function to download train stations for a specific country
+FIELDNAMES = ['id', 'uic', 'latitude', 'longitude', 'country', 'name', 'wikidata']
+
+OVERPASS_TIMEOUT = 600  # Seconds to wait for a country's stations
+
+# Shared session: keep-alive across countries and gzip-compressed JSON responses.
+# Rate-limited (429) and timed-out (504) queries are retried with backoff, honouring Retry-After
+session = requests.Session()
+session.headers.update({'Accept-Encoding': 'gzip'})
+session.mount('https://', requests.adapters.HTTPAdapter(
+    max_retries=Retry(total=5, status_forcelist=(429, 504), backoff_factor=5,
+                      respect_retry_after_header=True, raise_on_status=False)
+))
+
+def get_overpass_slots():
+    """
+    Read the number of concurrent query slots granted by the Overpass server,
+    or None if the status endpoint does not report it.
+    """
+    status_url = OVERPASS_URL.rsplit('/', 1)[0] + '/status'
+    try:
+        response = session.get(status_url, timeout=OVERPASS_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"Could not read Overpass status: {e}")
+        return None
+    match = re.search(r"Rate limit: (\d+)", response.text)
+    # A rate limit of 0 means the server does not limit slots
+    return (int(match.group(1)) or None) if match else None
+
+# Function to download train stations for a specific country, returning None if it failed
 def download_train_stations_for_country(country):
     query = get_train_stations_query(country)
     try:
-        result = api.query(query)
+        response = session.get(OVERPASS_URL, params={'data': query}, timeout=OVERPASS_TIMEOUT)
+        response.raise_for_status()
         stations_data = []
 
-        for station in result.nodes:
-            stations_data.append({
-                'id': station.id,
-                'uic': station.tags.get('uic_ref', ''),
-                'latitude': station.lat,
-                'longitude': station.lon,
-                'country': country,
-                'name': station.tags.get('name', '') or station.tags.get('uic_name', ''),
-                'wikidata': station.tags.get('wikidata', '')
-            })
+        # Read the JSON elements directly instead of building an object graph per node
+        for station in response.json()['elements']:
+            if station['type'] != 'node':
+                continue
+            tags = station.get('tags', {})
+            # Same column order as FIELDNAMES
+            stations_data.append((
+                station['id'],
+                tags.get('uic_ref', ''),
+                station['lat'],
+                station['lon'],
+                country,
+                tags.get('name', '') or tags.get('uic_name', ''),
+                tags.get('wikidata', '')
+            ))
 
         return stations_data
 
     except Exception as e:
         print(f"Failed to download train stations for {country}: {e}")
-        return []
-
-# Save station data to CSV
-def save_to_csv(all_stations_data, output_file):
-    with open(output_file, mode='w', newline='', encoding='utf-8') as csvfile:
-        fieldnames = ['id', 'uic', 'latitude', 'longitude', 'country', 'name', 'wikidata']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-
-        for station_data in all_stations_data:
-            writer.writerow(station_data)
+        return None
 
 parser = argparse.ArgumentParser(description='Download OSM train stations for multiple countries.')
 parser.add_argument('--output', type=str, default='osm_train_stations.csv',
                     help='Path to output CSV file (default: osm_train_stations.csv)')
+parser.add_argument('--workers', type=int, default=4,
+                    help='Number of countries downloaded concurrently, capped at the Overpass slots (default: 4)')
 args = parser.parse_args()
 
-all_stations_data = []
+station_count = 0
+failed_countries = []
+
+# The public Overpass API only grants a few parallel slots per client; extra queries get 429s
+slots = get_overpass_slots()
+workers = min(args.workers, slots) if slots else args.workers
+
+# Rows are written as each country completes instead of buffering every country until the end
+with open(args.output, mode='w', newline='', encoding='utf-8') as csvfile:
+    writer = csv.writer(csvfile)
+    writer.writerow(FIELDNAMES)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(download_train_stations_for_country, country): country for country in COUNTRIES}
 
-# Use ThreadPoolExecutor with one worker to avoid Overpass API rate limits
-with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-    results = executor.map(download_train_stations_for_country, COUNTRIES)
+        for future in tqdm(concurrent.futures.as_completed(futures), total=len(COUNTRIES)):
+            stations_data = future.result()
+            if stations_data is None:
+                failed_countries.append(futures[future])
+                continue
+            writer.writerows(stations_data)
+            station_count += len(stations_data)
 
-    for result in tqdm(results, total=len(COUNTRIES)):
-        all_stations_data.extend(result)
+print(f"Finished saving {station_count} train stations to '{args.output}'.")
 
-# Save to CSV
-save_to_csv(all_stations_data, args.output)
-print(f"Finished saving {len(all_stations_data)} train stations to '{args.output}'.")
+if failed_countries:
+    print(f"Missing train stations for {', '.join(sorted(failed_countries))}; '{args.output}' is incomplete.")
+    sys.exit(1)
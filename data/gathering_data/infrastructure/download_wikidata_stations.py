@@ -1,5 +1,6 @@
 import os
 import argparse
+from collections import defaultdict
 import pandas as pd
 from tqdm import tqdm
 from SPARQLWrapper import SPARQLWrapper, JSON
@@ -15,11 +16,14 @@ DEFAULT_EXCLUDED = {"Q233", "Q229"}  # Malta and Cyprus
 
 sparql = SPARQLWrapper("https://query.wikidata.org/sparql")
 
-def query_stations(country_id):
+def query_stations(country_ids):
+    """Query stations of all given countries at once, grouped by country ID."""
+    values = " ".join(f"wd:{country_id}" for country_id in country_ids)
     query = f"""
-    SELECT ?station ?stationLabel ?uic ?coord ?osmNode ?trainline ?osmRelation ?ibnr WHERE {{
+    SELECT ?country ?station ?stationLabel ?uic ?coord ?osmNode ?trainline ?osmRelation ?ibnr WHERE {{
+      VALUES ?country {{ {values} }}
       ?station wdt:P31/wdt:P279* wd:Q55488.
-      ?station wdt:P17 wd:{country_id}.
+      ?station wdt:P17 ?country.
       FILTER NOT EXISTS {{ ?station wdt:P31 wd:Q106772341. }}
       FILTER NOT EXISTS {{ ?station wdt:P576 ?dissolutionDate. }}
       FILTER NOT EXISTS {{ ?station wdt:P5817 wd:Q11639308. }}
@@ -38,9 +42,10 @@ def query_stations(country_id):
     sparql.setReturnFormat(JSON)
     results = sparql.query().convert()
 
-    data = []
+    data = defaultdict(list)
     for result in results["results"]["bindings"]:
-        data.append({
+        country_id = result["country"]["value"].split("/")[-1]
+        data[country_id].append({
             "Station": result.get("stationLabel", {}).get("value", ""),
             "Wikidata ID": result.get("station", {}).get("value", "").split("/")[-1],
             "UIC Code": result.get("uic", {}).get("value", ""),
@@ -75,20 +80,36 @@ print(f"Processing {len(countries)} countries...")
 
 os.makedirs(args.output_dir, exist_ok=True)
 
-for country in tqdm(countries, desc="Processing EU countries"):
+pending = []
+for country in countries:
     filename = os.path.join(args.output_dir, f"eu_railway_stations_{country}.csv")
-    
     if os.path.exists(filename) and not args.overwrite:
-        tqdm.write(f"Data for {country} already exists, skipping...")
-        continue
+        print(f"Data for {country} already exists, skipping...")
+    else:
+        pending.append(country)
 
+# A single query for every pending country instead of one request each; if it fails
+# (e.g. on the 60 s query timeout), each country is queried on its own, so a failure
+# only loses that country
+stations_by_country = {}
+if pending:
     try:
-        stations = query_stations(country)
+        stations_by_country = query_stations(pending)
     except Exception as e:
-        tqdm.write(f"Failed to query stations for {country}: {str(e)}")
-        continue
+        print(f"Combined query failed, querying countries one by one: {str(e)}")
+        failed = set()
+        for country in tqdm(pending, desc="Querying EU countries"):
+            try:
+                stations_by_country.update(query_stations([country]))
+            except Exception as e:
+                tqdm.write(f"Failed to query stations for {country}: {str(e)}")
+                failed.add(country)
+        pending = [country for country in pending if country not in failed]
+
+for country in tqdm(pending, desc="Saving EU countries"):
+    filename = os.path.join(args.output_dir, f"eu_railway_stations_{country}.csv")
 
-    df = pd.DataFrame(stations)
+    df = pd.DataFrame(stations_by_country.get(country, []))
     df.to_csv(filename, index=False, encoding="utf-8")
 
     if not df.empty:
@@ -1,4 +1,5 @@
 import os
+import json
 import subprocess
 import math
 import argparse
@@ -6,13 +7,42 @@ import osmium
 from scipy.spatial import cKDTree
 import numpy as np
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import logging
 import shutil
 
+try:
+    from numba import njit, prange  # Compiled distance kernel, optional
+except ImportError:
+    njit = None
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+QUERY_BATCH_SIZE = 65536  # Nodes per batched KDTree query
+SMALL_LOCATION_COUNT = 32  # Up to this many locations, distances are compared directly without a KDTree
+
+_location_tree = None  # KDTree over all locations, set once per worker process by init_filter_worker
+
+def init_filter_worker(location_tree):
+    """Keep the KDTree built by the parent process for every part this worker filters."""
+    global _location_tree
+    _location_tree = location_tree
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def near_any_location(coords, locations, radius_sq):
+        """Mask of the coords within sqrt(radius_sq) of any location, stopping at the first hit."""
+        near = np.zeros(len(coords), dtype=np.bool_)
+        for i in prange(len(coords)):
+            for j in range(len(locations)):
+                d_lat = coords[i, 0] - locations[j, 0]
+                d_lon = coords[i, 1] - locations[j, 1]
+                if d_lat * d_lat + d_lon * d_lon <= radius_sq:
+                    near[i] = True
+                    break
+        return near
+
 def get_osm_object_estimate(file_path):
     cmd = ["osmium", "fileinfo", "--no-progress", "-e", file_path]
     try:
@@ -46,7 +76,7 @@ def split_osm_file(osm_file_path, bounding_box, num_parts, output_dir):
     lon_step = (max_lon - min_lon) / grid_dimension
     lat_step = (max_lat - min_lat) / grid_dimension
 
-    split_files = []
+    split_files, extracts = [], []
     for row in range(grid_dimension):
         for col in range(grid_dimension):
             part_idx = row * grid_dimension + col + 1
@@ -55,55 +85,112 @@ def split_osm_file(osm_file_path, bounding_box, num_parts, output_dir):
             part_min_lat = min_lat + row * lat_step
             part_max_lat = part_min_lat + lat_step
 
-            extract_file_path = os.path.join(output_dir, f"part_{part_idx:04d}.osm.pbf")
-            bbox_str = f"{part_min_lon},{part_min_lat},{part_max_lon},{part_max_lat}"
-            cmd = ["osmium", "extract", "--bbox", bbox_str, "-o", extract_file_path, osm_file_path]
-            logger.info(f"Extracting part {part_idx}/{num_parts}: {bbox_str}")
-            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            split_files.append(extract_file_path)
+            extract_file_name = f"part_{part_idx:04d}.osm.pbf"
+            extracts.append({"output": extract_file_name,
+                             "bbox": [part_min_lon, part_min_lat, part_max_lon, part_max_lat]})
+            split_files.append(os.path.join(output_dir, extract_file_name))
+
+    # All parts are cut in a single pass over the input instead of one full scan per part
+    config_path = os.path.join(output_dir, "extracts.json")
+    with open(config_path, "w") as f:
+        json.dump({"directory": output_dir, "extracts": extracts}, f)
+
+    logger.info(f"Extracting {num_parts} parts in one pass")
+    cmd = ["osmium", "extract", "-c", config_path, osm_file_path]
+    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return split_files
 
+def find_nodes_near_locations(input_part_file, is_near, estimated_nodes=0):
+    """Return the ids of the nodes for which `is_near` holds, evaluating it on batches of (lat, lon).
+
+    Each batch is queried on a background thread while the next one is read,
+    so decoding the file and querying the locations overlap.
+    """
+    near_node_ids = set()
+    ids, coords = [], []
+    pending = None
+
+    def query_batch(batch_ids, batch_coords):
+        return batch_ids[is_near(batch_coords)]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Only nodes are decoded by the reader; ways and relations never reach Python
+        for obj in tqdm(osmium.FileProcessor(input_part_file, osmium.osm.NODE), total=estimated_nodes,
+                        unit="nodes", miniters=5000, desc=f"Scanning {os.path.basename(input_part_file)}"):
+            ids.append(obj.id)
+            coords.append((obj.location.lat, obj.location.lon))
+            if len(ids) >= QUERY_BATCH_SIZE:
+                # At most one batch is in flight, which bounds memory to two batches
+                if pending is not None:
+                    near_node_ids.update(pending.result().tolist())
+                pending = executor.submit(query_batch, np.asarray(ids), np.array(coords))
+                ids, coords = [], []
+
+        if pending is not None:
+            near_node_ids.update(pending.result().tolist())
+    if ids:
+        near_node_ids.update(query_batch(np.asarray(ids), np.array(coords)).tolist())
+    return near_node_ids
+
 def filter_osm_part_by_locations(input_part_file, output_filtered_file,
-                                  all_locations_array, radius_km,
+                                  locations_file, radius_km,
                                   estimated_objects_in_part, query_ball_workers,
                                   part_bounding_box):
+    # Memory-mapped read-only, so all worker processes share the same physical pages
+    all_locations_array = np.load(locations_file, mmap_mode='r')
     min_lon, min_lat, max_lon, max_lat = part_bounding_box
     radius_deg_approx = radius_km / 111.32
     buffered_min_lon, buffered_min_lat = min_lon - radius_deg_approx, min_lat - radius_deg_approx
     buffered_max_lon, buffered_max_lat = max_lon + radius_deg_approx, max_lat + radius_deg_approx
 
-    relevant_locations_array = np.array([
-        loc for loc in all_locations_array
-        if buffered_min_lat <= loc[0] <= buffered_max_lat and
-           buffered_min_lon <= loc[1] <= buffered_max_lon
-    ])
+    lat, lon = all_locations_array[:, 0], all_locations_array[:, 1]
+    in_bbox = ((lat >= buffered_min_lat) & (lat <= buffered_max_lat) &
+               (lon >= buffered_min_lon) & (lon <= buffered_max_lon))
+    relevant_locations_array = all_locations_array[in_bbox]
 
     if relevant_locations_array.size == 0:
         logger.info(f"No relevant locations for {os.path.basename(input_part_file)}. Creating empty file.")
         osmium.SimpleWriter(output_filtered_file).close()
         return output_filtered_file
 
-    kdtree = cKDTree(relevant_locations_array)
+    if len(relevant_locations_array) <= SMALL_LOCATION_COUNT and njit is not None:
+        # For a handful of locations, a compiled scan is cheaper than querying the full tree
+        def is_near(coords):
+            return near_any_location(coords, relevant_locations_array, radius_deg_approx ** 2)
+    elif len(relevant_locations_array) <= SMALL_LOCATION_COUNT:
+        # Without numba, broadcasting all distances is still cheaper than a tree
+        def is_near(coords):
+            diff = coords[:, None, :] - relevant_locations_array[None, :, :]
+            return ((diff ** 2).sum(axis=2) <= radius_deg_approx ** 2).any(axis=1)
+    else:
+        # The tree spans all locations and prunes far-away ones itself, so it is never rebuilt per part
+        def is_near(coords):
+            return _location_tree.query_ball_point(coords, r=radius_deg_approx,
+                                                   workers=query_ball_workers, return_length=True) > 0
+
+    # osmium objects are only valid while iterating, so the matching node ids are
+    # collected first (one vectorised query per batch) and written in a second pass
+    near_node_ids = find_nodes_near_locations(input_part_file, is_near, estimated_objects_in_part)
     writer = osmium.BackReferenceWriter(output_filtered_file, ref_src=input_part_file, overwrite=True)
-    
+
     with writer:
-        for obj in tqdm(osmium.FileProcessor(input_part_file), total=estimated_objects_in_part,
-                        unit="objects", miniters=5000, desc=f"Filtering {os.path.basename(input_part_file)}"):
-            if isinstance(obj, osmium.osm.Node):
-                if kdtree.query_ball_point((obj.location.lat, obj.location.lon), r=radius_km / 111.32,
-                                             workers=query_ball_workers, return_length=True) > 0:
-                    writer.add(obj)
+        # The id filter runs in C, so only the matching nodes are handed to Python
+        nodes = osmium.FileProcessor(input_part_file, osmium.osm.NODE).with_filter(osmium.filter.IdFilter(near_node_ids))
+        for obj in nodes:
+            writer.add(obj)
     logger.info(f"Completed filtering {os.path.basename(input_part_file)}.")
     return output_filtered_file
 
-def merge_osm_files(osm_file_paths, merged_output_file_path):
+def merge_osm_files(osm_file_paths, merged_output_file_path, fast_concat=False):
     if not osm_file_paths:
         logger.warning("No files to merge. Creating an empty output file.")
         osmium.SimpleWriter(merged_output_file_path).close()
         return merged_output_file_path
 
     logger.info(f"Merging {len(osm_file_paths)} files into: {merged_output_file_path}")
-    cmd = ["osmium", "merge", "-o", merged_output_file_path] + osm_file_paths
+    # Parts share nodes and ways, so merge sorts them and drops the repeats;
+    # concatenation is linear but leaves them unsorted and duplicated
+    cmd = ["osmium", "cat" if fast_concat else "merge", "-o", merged_output_file_path] + osm_file_paths
     subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     logger.info(f"Merged output saved to: {merged_output_file_path}")
     return merged_output_file_path
@@ -121,6 +208,7 @@ if __name__ == "__main__":
     parser.add_argument("--filter-workers", type=int, default=1, help="Parallel processes for filtering parts")
     parser.add_argument("--query-ball-workers", type=int, default=-1, help="Workers for KDTree queries (-1 for all cores)")
     parser.add_argument("--force", action="store_true", help="Overwrite existing files/directories")
+    parser.add_argument("--fast-concat", action="store_true", help="Concatenate the parts with osmium cat instead of merging them (faster, but leaves duplicate objects unsorted)")
     args = parser.parse_args()
 
     if os.path.exists(args.working_dir) and args.force: shutil.rmtree(args.working_dir)
@@ -171,9 +259,15 @@ if __name__ == "__main__":
     estimated_total_objects = get_osm_object_estimate(current_osm_input)
     per_file_estimate = max(1, estimated_total_objects // len(split_files)) if estimated_total_objects else 0
 
+    # Workers receive the path of a float32 copy instead of a pickled array each
+    shared_locations_file = os.path.join(args.working_dir, "locations.npy")
+    np.save(shared_locations_file, locations_array.astype(np.float32))
+
     logger.info(f"Filtering split files with {args.filter_workers} processes...")
     filter_tasks = []
-    with ProcessPoolExecutor(max_workers=args.filter_workers) as executor:
+    location_tree = cKDTree(locations_array)
+    with ProcessPoolExecutor(max_workers=args.filter_workers, initializer=init_filter_worker,
+                             initargs=(location_tree,)) as executor:
         for idx, split_file_path in enumerate(split_files):
             filtered_file_path = os.path.join(filtered_output_dir, f"filtered_{os.path.basename(split_file_path)}")
             
@@ -185,7 +279,7 @@ if __name__ == "__main__":
                                  min_lon + (col + 1) * lon_step, min_lat + (row + 1) * lat_step)
 
             future = executor.submit(filter_osm_part_by_locations, split_file_path, filtered_file_path,
-                                    locations_array, args.radius, per_file_estimate,
+                                    shared_locations_file, args.radius, per_file_estimate,
                                     args.query_ball_workers, current_part_bbox)
             filter_tasks.append(future)
 
@@ -197,5 +291,5 @@ if __name__ == "__main__":
                 raise
 
     logger.info("Merging filtered files...")
-    merge_osm_files(final_filtered_parts, args.merged_output_file)
+    merge_osm_files(final_filtered_parts, args.merged_output_file, fast_concat=args.fast_concat)
     logger.info("Processing complete!")
\ No newline at end of file
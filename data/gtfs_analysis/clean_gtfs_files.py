@@ -1,14 +1,44 @@
 import argparse
 import os
 import zipfile
+import zlib
 import csv
 from tqdm import tqdm
-from concurrent.futures import ProcessPoolExecutor
-from tempfile import NamedTemporaryFile
-from io import TextIOWrapper
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+from io import StringIO, TextIOWrapper
 import shutil
+import queue
 from datetime import datetime
-import subprocess
+from functools import lru_cache
+import types
+import threading
+from gtfs_utils import quick_check, interleave_round_robin, attempt_fix_zip, central_dir, COPY_CHUNK_SIZE
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
+try:
+    from isal import isal_zlib  # SIMD DEFLATE and CRC32 from Intel ISA-L, optional
+except ImportError:
+    isal_zlib = None
+
+if isal_zlib is not None:
+    def isal_compressobj(level=zlib.Z_DEFAULT_COMPRESSION, method=zlib.DEFLATED, wbits=-15):
+        # ISA-L only has levels 0-3: zlib levels 1-3, 4-6 and 7-9 map to 1, 2 and 3
+        isal_level = isal_zlib.ISAL_DEFAULT_COMPRESSION if level < 0 else min(3, (level + 2) // 3)
+        return isal_zlib.compressobj(isal_level, method, wbits)
+
+    # zipfile looks these up at call time, so every archive written or read below uses ISA-L
+    zipfile.zlib = types.SimpleNamespace(
+        compressobj=isal_compressobj, decompressobj=isal_zlib.decompressobj, error=isal_zlib.error,
+        DEFLATED=zlib.DEFLATED, Z_DEFAULT_COMPRESSION=zlib.Z_DEFAULT_COMPRESSION
+    )
+    zipfile.crc32 = isal_zlib.crc32
 
 FILES_TO_INCLUDE = [
     "agency.txt", "stops.txt", "routes.txt", "trips.txt", "stop_times.txt",
@@ -35,122 +65,379 @@ rail_services = [
 ]
 rail_services = [2, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117]
 
-def quick_check(file_path):
-    """Perform a quick comparison using size and CRC32."""
-    crc32s = []
-    try:
-        with zipfile.ZipFile(file_path, 'r') as zip_file:
-            for file_info in sorted(zip_file.infolist(), key=lambda x: x.filename):
-                crc32s.append((file_info.filename, file_info.CRC))
-                with zip_file.open(file_info.filename) as _:
-                    pass
-        return tuple(crc32s)  # Immutable tuple as hash key
-    except Exception as e:
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    """Parse a GTFS YYYYMMDD date; feeds repeat a small set of dates across many rows."""
+    return datetime.strptime(value, "%Y%m%d").date()
+
+def in_date_range(value, date_range):
+    min_date, max_date = date_range
+    date = parse_date(value)
+    return (min_date is None or min_date <= date) and (max_date is None or date <= max_date)
+
+def arrow_date_range_mask(column, date_range):
+    """Boolean mask of the YYYYMMDD strings in `column` within the inclusive (min_date, max_date) range."""
+    dates = pc.strptime(column, format="%Y%m%d", unit="s", error_is_null=True)
+    mask = pc.is_valid(dates)
+    for bound, compare in zip(date_range, (pc.greater_equal, pc.less_equal)):
+        if bound is not None:
+            bound = pa.scalar(datetime.combine(bound, datetime.min.time()), type=pa.timestamp("s"))
+            mask = pc.and_(mask, compare(dates, bound))
+    return mask
+
+ARROW_BLOCK_SIZE = 16 << 20  # Bytes of CSV per Arrow batch, roughly 250k stop_times.txt rows
+
+def filter_file_with_arrow(infile, outfile, check_column_name, check_column_values, columns_to_keep, date_range=None):
+    """
+    Vectorised version of the filter in filter_file_from_zip, using PyArrow.
+    The file is streamed in blocks of ARROW_BLOCK_SIZE bytes, each filtered with a boolean
+    mask and appended to the binary outfile, so memory stays bounded for large stop_times.txt files.
+    Values are written unquoted, like the other paths; a batch with a comma, quote or newline in
+    a value is instead written with every value quoted, which is equivalent CSV but not byte-identical.
+    Raises pa.ArrowInvalid or UnicodeDecodeError if the file is not well-formed UTF-8 CSV,
+    in which case the caller falls back to the other paths.
+    """
+    # Read every column as a string, like the csv module does
+    raw_header = next(csv.reader([infile.readline().decode('utf-8-sig')]))
+    names = [col.strip() for col in raw_header]
+    reader = pa_csv.open_csv(
+        infile,
+        read_options=pa_csv.ReadOptions(column_names=raw_header, block_size=ARROW_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(column_types={col: pa.string() for col in raw_header},
+                                              strings_can_be_null=False)
+    )
+
+    filter_column = check_column_name in names and (date_range is not None or check_column_values is not True)
+    if filter_column and date_range is None:
+        value_set = pa.array(list(check_column_values), type=pa.string())
+    return_column_values = [set() for _ in columns_to_keep]
+
+    schema = pa.schema([(name, pa.string()) for name in names])
+    # Arrow quotes header names whatever the quoting style, so the header is written by the csv module
+    header = StringIO()
+    csv.writer(header, lineterminator='\n').writerow(names)
+    outfile.write(header.getvalue().encode('utf-8'))
+    for batch in reader:
+        batch = pa.RecordBatch.from_arrays([pc.utf8_trim_whitespace(column) for column in batch.columns], schema=schema)
+        if filter_column and date_range is not None:
+            batch = batch.filter(arrow_date_range_mask(batch.column(check_column_name), date_range))
+        elif filter_column:
+            batch = batch.filter(pc.is_in(batch.column(check_column_name), value_set=value_set))
+
+        for values, col in zip(return_column_values, columns_to_keep):
+            if col in names:
+                values.update(pc.unique(batch.column(col)).to_pylist())
+        try:
+            buffer = pa.BufferOutputStream()
+            pa_csv.write_csv(batch, buffer, write_options=pa_csv.WriteOptions(include_header=False, quoting_style='none'))
+        except pa.ArrowInvalid:
+            # 'none' refuses values with delimiters, quotes or newlines
+            buffer = pa.BufferOutputStream()
+            pa_csv.write_csv(batch, buffer, write_options=pa_csv.WriteOptions(include_header=False, quoting_style='needed'))
+        outfile.write(buffer.getvalue())
+
+    return [values - {''} for values in return_column_values]
+
+# Opaque ID columns that never need CSV quoting in practice, so rows can be split on raw commas
+SIMPLE_KEY_COLUMNS = frozenset({"route_type", "route_id", "agency_id", "trip_id", "stop_id", "from_stop_id", "service_id"})
+
+def filter_file_by_bytes(infile, outfile, check_column_name, check_column_values, columns_to_keep):
+    """
+    Membership filter on raw bytes: lines are split on commas and matching lines whose fields
+    need no stripping are written through with a '\n' terminator, so they are never re-encoded.
+    Other matching lines are rebuilt from their stripped fields, as the csv path writes them.
+    Lines containing quotes are parsed with the csv module.
+    Every kept line is checked to be UTF-8, raising UnicodeDecodeError otherwise, so that
+    other encodings are left to the csv path, which transcodes them.
+    Returns None if the header is quoted or lacks the check column.
+    """
+    header_line = infile.readline()
+    header = [col.strip() for col in header_line.decode('utf-8-sig').rstrip('\r\n').split(',')]
+    if b'"' in header_line or check_column_name not in header:
         return None
 
-def interleave_round_robin(files):
-    sorted_files = sorted(files, key=lambda x: os.stat(x).st_size)
-    n = len(sorted_files)
-
-    # Split into quartiles
-    very_large = sorted_files[3 * n // 4:]
-    large = sorted_files[n // 2:3 * n // 4]
-    medium = sorted_files[n // 4:n // 2]
-    small = sorted_files[:n // 4]
-
-    interleaved = []
-    while any([very_large, large, medium, small]):
-        if very_large:
-            interleaved.append(very_large.pop())
-        if small:
-            interleaved.append(small.pop())
-        if large:
-            interleaved.append(large.pop())
-        if medium:
-            interleaved.append(medium.pop())
-
-    return interleaved
-
-def filter_file_from_zip(zip_ref, input_file, output_folder, check_column_name, check_column_values, columns_to_keep=[], filter_function=None):
+    column_idx = header.index(check_column_name)
+    return_column_indices = [header.index(col) if col in header else None for col in columns_to_keep]
+    return_column_values = [set() for _ in columns_to_keep]
+    wanted = frozenset(value.encode() for value in check_column_values)
+
+    # Quoted rows are re-quoted the way the csv path writes them
+    row_buffer = StringIO()
+    row_writer = csv.writer(row_buffer, lineterminator='\n')
+
+    outfile.write(','.join(header).encode() + b'\n')
+    for line in infile:
+        quoted = b'"' in line
+        line = line.rstrip(b'\r\n')
+        if quoted:
+            fields = [field.encode() for field in next(csv.reader([line.decode()]), [])]
+        else:
+            fields = line.split(b',')
+        if len(fields) <= column_idx or fields[column_idx].strip() not in wanted:
+            continue
+        if not quoted:
+            line.decode('utf-8')  # Quoted lines were already decoded above
+
+        stripped = [field.strip() for field in fields]
+        for values, idx in zip(return_column_values, return_column_indices):
+            if idx is not None and idx < len(stripped) and stripped[idx]:
+                values.add(stripped[idx].decode())
+
+        if not quoted and stripped == fields:
+            outfile.write(line + b'\n')
+        elif not quoted:
+            outfile.write(b','.join(stripped) + b'\n')
+        else:
+            row_buffer.seek(0)
+            row_buffer.truncate()
+            row_writer.writerow([field.decode() for field in stripped])
+            outfile.write(row_buffer.getvalue().encode())
+
+    return return_column_values
+
+def filter_file_with_csv(infile, outfile, encoding, check_column_name, check_column_values, columns_to_keep, date_range=None):
+    """
+    Filter with the csv module, decoding the binary infile with the given encoding and writing
+    UTF-8 to the binary outfile. Neither file is closed.
+    """
+    return_column_values = [set() for _ in columns_to_keep]
+    text_outfile = TextIOWrapper(outfile, encoding='utf-8', newline='\n')
+    # Kept in a variable and detached, never left to the garbage collector, which would close infile
+    text_infile = TextIOWrapper(infile, encoding=encoding)
+    try:
+        reader = csv.reader(text_infile)
+        writer = csv.writer(text_outfile, lineterminator='\n')  # Same line endings as the other paths
+
+        header = [col.strip() for col in next(reader)]
+        writer.writerow(header)
+
+        return_column_indices = [header.index(col) if col in header else None for col in columns_to_keep]
+
+        try:
+            column_idx = header.index(check_column_name)
+        except ValueError:
+            column_idx = None
+            if not columns_to_keep:
+                writer.writerows(reader)
+                return return_column_values
+
+        if check_column_values is True and date_range is None:
+            filter_function = lambda value: True
+        elif date_range is None:
+            filter_function = check_column_values.__contains__  # Bound once, not looked up per row
+        else:
+            filter_function = lambda value: in_date_range(value, date_range)
+
+        for row in reader:
+            row = [value.strip() for value in row]
+            if not row:
+                continue
+
+            if column_idx is None or filter_function(row[column_idx]):
+                for i, idx in enumerate(return_column_indices):
+                    if idx is not None and row[idx]:
+                        return_column_values[i].add(row[idx])
+
+                writer.writerow(row)
+    finally:
+        # Hand both files back to the caller without closing them
+        text_outfile.flush()
+        text_outfile.detach()
+        text_infile.detach()
+
+    return return_column_values
+
+def filter_csv(open_input, outfile, description, check_column_name, check_column_values, columns_to_keep, date_range=None):
+    """
+    Writes the rows of the CSV returned by open_input() that pass the filter to the binary outfile,
+    and returns the unique values of the columns_to_keep. Tries Arrow, then the raw-bytes filter,
+    then the csv module, rewinding outfile before each fallback.
+    """
+    if pa is not None:
+        try:
+            with open_input() as infile:
+                return filter_file_with_arrow(infile, outfile, check_column_name, check_column_values, columns_to_keep, date_range)
+        except (pa.ArrowInvalid, UnicodeDecodeError) as e:
+            tqdm.write(f"Falling back from Arrow for {description}: {e}")
+            outfile.seek(0)
+            outfile.truncate()
+
+    if date_range is None and check_column_values is not True and check_column_name in SIMPLE_KEY_COLUMNS:
+        try:
+            with open_input() as infile:
+                result = filter_file_by_bytes(infile, outfile, check_column_name, check_column_values, columns_to_keep)
+            if result is not None:
+                return result
+        except UnicodeDecodeError:
+            pass  # Not UTF-8: the csv module below retries as latin1
+        outfile.seek(0)
+        outfile.truncate()
+
+    # A row that is not UTF-8, even after the header, restarts the file as latin1, which always decodes
+    try:
+        with open_input() as infile:
+            return filter_file_with_csv(infile, outfile, 'utf-8-sig', check_column_name, check_column_values, columns_to_keep, date_range)
+    except UnicodeDecodeError:
+        tqdm.write(f"Error reading file {description} - trying latin1 encoding")
+        outfile.seek(0)
+        outfile.truncate()
+    with open_input() as infile:
+        return filter_file_with_csv(infile, outfile, 'latin1', check_column_name, check_column_values, columns_to_keep, date_range)
+
+def filter_file_from_zip(zip_ref, input_file, output_folder, check_column_name, check_column_values, columns_to_keep=[], date_range=None, output_spool=None):
     """
     Filters a file inside the ZIP and stores the filtered content in output_file.
+    Rows are kept if their check column is in check_column_values or, when date_range
+    is given as (min_date, max_date), if it is a date in that range (None bounds are open).
     It also returns the unique values of the columns_to_keep.
     If the output_file already exists, it reads and writes to the same file safely.
+    If output_spool is given, the content is written there instead and output_file is removed:
+    the last step on a file hands it to the ZIP writer without a round trip through the disk.
     """
-    return_column_values = [set() for _ in columns_to_keep]
     corresponding_files = [f for f in zip_ref.namelist() if f == input_file or f.endswith('/' + input_file)]
     if not corresponding_files:
-        return return_column_values
+        return [set() for _ in columns_to_keep]
 
     output_file = os.path.join(output_folder, input_file)
 
     # Determine whether to read from an existing output file
     output_file_exists = os.path.exists(output_file)
+    def open_input():
+        return open(output_file, 'rb') if output_file_exists else zip_ref.open(corresponding_files[0], 'r')
 
-    with (open(output_file, 'r', encoding='utf-8') if output_file_exists else zip_ref.open(corresponding_files[0], 'r')) as infile, \
-        NamedTemporaryFile('w', delete=False, newline='\n', encoding='utf-8', dir=output_folder) as temp_outfile:
+    description = f"{input_file} ({zip_ref.filename})"
+    if output_spool is not None:
+        return_column_values = filter_csv(open_input, output_spool, description, check_column_name, check_column_values, columns_to_keep, date_range)
+        if output_file_exists:
+            os.remove(output_file)
+        return return_column_values
 
-        with TextIOWrapper(infile, encoding='utf-8-sig') if not output_file_exists else infile as infile_wrapper:
-            reader = csv.reader(infile_wrapper)
-            writer = csv.writer(temp_outfile)
+    temp_file = output_file + '.tmp'
+    with open(temp_file, 'w+b') as outfile:
+        return_column_values = filter_csv(open_input, outfile, description, check_column_name, check_column_values, columns_to_keep, date_range)
+    # Replace the original file with the temporary file
+    os.replace(temp_file, output_file)
 
-            try:
-                header = [col.strip() for col in next(reader)]
-            except UnicodeDecodeError:
-                tqdm.write(f"Error reading file {input_file} ({zip_ref.filename}) - trying latin1 encoding")
-                infile.seek(0)
-                reader = csv.reader(TextIOWrapper(infile, encoding='latin1'))
-                header = [col.strip() for col in next(reader)]
-            writer.writerow(header)
+    return return_column_values
 
-            return_column_indices = [header.index(col) if col in header else None for col in columns_to_keep]
 
-            try:
-                column_idx = header.index(check_column_name)
-            except ValueError:
-                column_idx = None
-                if not columns_to_keep:
-                    writer.writerows(reader)
-                    temp_outfile.close()
-                    os.replace(temp_outfile.name, output_file)
-                    return return_column_values
-
-            if filter_function is None:
-                filter_function = lambda value: check_column_values==True or value in check_column_values
-
-            for row in reader:
-                row = [value.strip() for value in row]
-                if not row:
-                    continue
-
-                if column_idx is None or filter_function(row[column_idx]):
-                    for i, idx in enumerate(return_column_indices):
-                        if idx is not None and row[idx]:
-                            return_column_values[i].add(row[idx])
-
-                    writer.writerow(row)
+def parse_dependency(file_data):
+    """
+    Unpack a file_dependencies entry into (file, column, columns_to_keep, date_range, add).
+    """
+    file, column = file_data[0], file_data[1]
+    columns_to_keep = file_data[2] if len(file_data) > 2 else []
+    date_range = file_data[3] if len(file_data) > 3 else None
+    add = file_data[4] if len(file_data) > 4 else False
+    return file, column, columns_to_keep, date_range, add
 
-    # Replace the original file with the temporary file
-    os.replace(temp_outfile.name, output_file)
+def dependency_layers(steps):
+    """
+    Group parsed file_dependencies into layers of steps that can run concurrently.
+    A step comes after every earlier step on the same file and every earlier step that
+    produces a value it filters on, and no earlier than the steps reading values it replaces.
+    Steps in a layer read the values from before the layer; results are applied in order.
+    """
+    step_layers = []
+    file_layer, writer_layer, reader_layer = {}, {}, {}
+    for file, column, columns_to_keep, _, add in steps:
+        read = column[5:] if column.startswith('from_') else column[3:] if column.startswith('to_') else column
+        reads = {read, columns_to_keep[0]} if add else {read}
 
-    return return_column_values
+        layer = max([file_layer.get(file, -1) + 1]
+                    + [writer_layer[variable] + 1 for variable in reads if variable in writer_layer]
+                    + [max(reader_layer.get(variable, 0), writer_layer.get(variable, 0)) for variable in columns_to_keep])
+
+        file_layer[file] = layer
+        for variable in reads:
+            reader_layer[variable] = max(reader_layer.get(variable, 0), layer)
+        for variable in columns_to_keep:
+            writer_layer[variable] = layer
+        step_layers.append(layer)
 
+    layers = [[] for _ in range(max(step_layers, default=-1) + 1)]
+    for i, layer in enumerate(step_layers):
+        layers[layer].append(i)
+    return layers
 
-def filter_gtfs_by_route_type(zip_file_path, output_zip_file, route_types_to_keep, files_to_include, compresslevel=6, start_date=None, end_date=None):
+def required_columns(steps):
+    """
+    For each parsed file_dependencies step, the columns it produces that a later step filters on
+    before any step adds to them. If one of these comes out empty, nothing downstream can match.
+    """
+    required = []
+    for i, (_, _, columns_to_keep, _, _) in enumerate(steps):
+        columns = set()
+        for column in columns_to_keep:
+            for _, check_column, later_columns, _, add in steps[i + 1:]:
+                if check_column in (column, 'from_' + column, 'to_' + column):
+                    columns.add(column)
+                    break
+                if add and column in later_columns:
+                    break  # A later step extends the values, so an empty set is not final yet
+        required.append(columns)
+    return required
+
+SPOOL_MAX_SIZE = 16 << 20  # Final filtered files larger than this wait on disk instead of in memory
+
+def write_zip_from_queue(output_zip_file, compresslevel, files_queue):
+    """
+    Compress the (name, spool) pairs received on files_queue into output_zip_file until a None
+    sentinel is received, closing each spool. ZipFile is not thread-safe, so a single thread
+    does all the writing.
+    """
+    finished = False
+    try:
+        with zipfile.ZipFile(output_zip_file, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zip_out:
+            for name, spool in iter(files_queue.get, None):
+                with spool, zip_out.open(name, 'w', force_zip64=spool.tell() * 1.05 > zipfile.ZIP64_LIMIT) as member:
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, member, COPY_CHUNK_SIZE)
+            finished = True
+    except Exception:
+        # Keep draining so that the filtering side never blocks on a full queue
+        while not finished:
+            item = files_queue.get()
+            finished = item is None
+            if item is not None:
+                item[1].close()
+        raise
+
+def readahead(file_path):
+    """
+    Ask the kernel to load the whole file into the page cache in the background, so that
+    the scattered member reads that follow are served from memory. No-op where unsupported.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def filter_gtfs_by_route_type(zip_file_path, output_zip_file, route_types_to_keep, files_to_include, compresslevel=6, start_date=None, end_date=None, inner_threads=1, preload=False):
     """
     Filters GTFS files inside a ZIP archive based on route_type.
+    With inner_threads > 1, independent files are filtered concurrently, each thread
+    reading through its own handle on the archive. With preload, the archive is read
+    ahead into the page cache before filtering starts.
     """
+    if preload:
+        readahead(zip_file_path)
     tmp_folder = output_zip_file.split('.zip')[0]
     os.makedirs(tmp_folder, exist_ok=True)
+    # Values are frozensets, combined with | so that a step never mutates a set another step reads
     variables_to_keep = {}
+    route_type_values = frozenset(str(rt) for rt in route_types_to_keep)
     def get_variables_to_keep(key):
         if key.startswith('from_'):
             return variables_to_keep[key[5:]]
         if key.startswith('to_'):
             return variables_to_keep[key[3:]]
         if key == 'route_type':
-            return [str(rt) for rt in route_types_to_keep]
-        return variables_to_keep.get(key, [])
+            return route_type_values
+        return variables_to_keep.get(key, frozenset())
     
     file_dependencies = [
         ("routes.txt", "route_type", ["route_id", "agency_id"]),
@@ -169,9 +456,9 @@ def filter_gtfs_by_route_type(zip_file_path, output_zip_file, route_types_to_kee
     ]
     if start_date and end_date:
         date_file_dependencies = [
-            ("calendar_dates.txt", "date", ["service_id"], lambda value: start_date <= datetime.strptime(value, "%Y%m%d").date() <= end_date),
-            ("calendar.txt", "start_date", ["service_id"], lambda value: datetime.strptime(value, "%Y%m%d").date() <= end_date, True),
-            ("calendar.txt", "end_date", ["service_id"], lambda value: datetime.strptime(value, "%Y%m%d").date() >= start_date, True),
+            ("calendar_dates.txt", "date", ["service_id"], (start_date, end_date)),
+            ("calendar.txt", "start_date", ["service_id"], (None, end_date), True),
+            ("calendar.txt", "end_date", ["service_id"], (start_date, None), True),
             # TODO: this doesn't fully filter, as it keeps rows that end a lot after the end date or start a lot before the start date
             # but it does remove the rows that are completely outside the range
             ("trips.txt", "service_id", ["service_id"]),
@@ -181,77 +468,117 @@ def filter_gtfs_by_route_type(zip_file_path, output_zip_file, route_types_to_kee
         trips_index = [i for i, file_data in enumerate(file_dependencies) if file_data[0] == 'trips.txt'][0]
         file_dependencies = file_dependencies[:trips_index] + date_file_dependencies + file_dependencies[trips_index+1:]
     
-    with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-        for file_data in file_dependencies:
-            file = file_data[0]
-            column = file_data[1]
-            columns_to_keep = []
-            filter_function = None
-            add = False
-            if len(file_data)>2:
-                columns_to_keep = file_data[2]
-            if len(file_data)>3:
-                filter_function = file_data[3]
-            if len(file_data)>4:
-                add = file_data[4]
-            if add:
-                existing_values = variables_to_keep.get(columns_to_keep[0], [])
-                new_values = filter_file_from_zip(zip_ref, file, tmp_folder, column, get_variables_to_keep(column), columns_to_keep, filter_function)
-                for i, column in enumerate(columns_to_keep):
-                    variables_to_keep[column] = set(existing_values).union(new_values[i])
-            else:
-                variables_to_keep.update(zip(columns_to_keep, filter_file_from_zip(zip_ref, file, tmp_folder, column, get_variables_to_keep(column), columns_to_keep, filter_function)))
-
-            if 'route_id' in columns_to_keep and not variables_to_keep['route_id']:
-                shutil.rmtree(tmp_folder)
-                return False
-            if 'agency_id' in columns_to_keep and not variables_to_keep['agency_id']:
-                tqdm.write(f"Warn: No agency_id found in {zip_file_path}, keeping all agencies")
-                variables_to_keep['agency_id'] = True
-
-    # zip all files in tmp_folder (excluding the folder itself)
-    with zipfile.ZipFile(output_zip_file, 'w') as zip_ref:
-        for root, _, files in os.walk(tmp_folder):
-            for file in files:
-                if file in files_to_include:
-                    zip_ref.write(os.path.join(root, file), file, compress_type=zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
-    shutil.rmtree(tmp_folder)
-    return True
+    # Listing cached by quick_check: files missing from the archive are skipped without reading it
+    member_names = [file_info.filename for file_info in central_dir(zip_file_path)]
+    def run_step(zip_ref, step_index, check_values, output_spool):
+        file, column, columns_to_keep, date_range, _ = steps[step_index]
+        if not any(name == file or name.endswith('/' + file) for name in member_names):
+            return [set() for _ in columns_to_keep]
+        return filter_file_from_zip(zip_ref, file, tmp_folder, column, check_values, columns_to_keep, date_range, output_spool)
+
+    thread_handles, own_handles = threading.local(), []
+    def run_step_with_own_handle(step_index, check_values, output_spool):
+        # A separate ZipFile per thread, kept for the whole archive, so concurrent member
+        # reads do not share a file position and each thread parses the directory only once
+        if not hasattr(thread_handles, 'zip_ref'):
+            thread_handles.zip_ref = zipfile.ZipFile(zip_file_path, 'r')
+            own_handles.append(thread_handles.zip_ref)
+        return run_step(thread_handles.zip_ref, step_index, check_values, output_spool)
+
+    steps = [parse_dependency(file_data) for file_data in file_dependencies]
+    # After the last step writing a file, it is final and can be compressed while filtering continues
+    last_step = {step[0]: i for i, step in enumerate(steps)}
+    required = required_columns(steps)
+
+    def filter_files(files_queue):
+        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref, ThreadPoolExecutor(max_workers=inner_threads) as executor:
+            for layer in dependency_layers(steps):
+                layer_steps = [steps[i] for i in layer]
+                check_values = [get_variables_to_keep(step[1]) for step in layer_steps]
+                existing_values = [variables_to_keep.get(step[2][0], frozenset()) if step[4] else None for step in layer_steps]
+                # The last step on an included file writes into a spool that goes straight to the ZIP writer
+                spools = [SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=tmp_folder)
+                          if last_step[file] == i and file in files_to_include else None
+                          for i, (file, *_) in zip(layer, layer_steps)]
+
+                try:
+                    if inner_threads > 1 and len(layer_steps) > 1:
+                        results = list(executor.map(run_step_with_own_handle, layer, check_values, spools))
+                    else:
+                        results = [run_step(zip_ref, i, values, spool) for i, values, spool in zip(layer, check_values, spools)]
 
-def attempt_fix_zip(file_path, tmp_dir="tmp"):
-    """Attempt to fix a corrupted zip file using the zip -FF command and remove problematic files."""
-    os.makedirs(tmp_dir, exist_ok=True)
+                    for step_index, (_, _, columns_to_keep, _, add), existing, new_values in zip(layer, layer_steps, existing_values, results):
+                        if add:
+                            for i, column in enumerate(columns_to_keep):
+                                variables_to_keep[column] = existing | new_values[i]
+                        else:
+                            variables_to_keep.update(zip(columns_to_keep, map(frozenset, new_values)))
+
+                        # No routes, trips, services or stops left: skip the remaining passes (e.g. stop_times.txt)
+                        if any(not variables_to_keep[column] for column in required[step_index] - {'agency_id'}):
+                            return False
+                        if 'agency_id' in columns_to_keep and not variables_to_keep['agency_id']:
+                            tqdm.write(f"Warn: No agency_id found in {zip_file_path}, keeping all agencies")
+                            variables_to_keep['agency_id'] = True
+
+                    for k, (file, *_) in enumerate(layer_steps):
+                        # An empty spool means the file is not in the archive
+                        if spools[k] is not None and spools[k].tell():
+                            files_queue.put((file, spools[k]))
+                            spools[k] = None  # Now closed by the writer
+                finally:
+                    for spool in spools:
+                        if spool is not None:
+                            spool.close()
+        return True
+
+    files_queue = queue.Queue(maxsize=4)
+    # The output is often the input archive itself (in-place mode), which is still being read
+    # while the writer runs, so it is only moved into place once filtering is done
+    temp_zip_file = output_zip_file + '.tmp'
     try:
-        tmp_file = os.path.join(tmp_dir, os.path.basename(file_path).split('.')[0] + '_tmp.zip')
-        fixed_file_path = os.path.join(tmp_dir, os.path.basename(file_path))
-        result = subprocess.run(['zip', '-FF', file_path, '--out', tmp_file], input='y\n', capture_output=True, text=True)
-        if result.returncode == 0:
-            with zipfile.ZipFile(tmp_file, 'r') as in_zip:
-                with zipfile.ZipFile(fixed_file_path, 'w') as out_zip:
-                    for file_info in in_zip.infolist():
-                        try:
-                            with in_zip.open(file_info.filename) as infile:
-                                out_zip.writestr(file_info, infile.read())
-                        except Exception as e:
-                            tqdm.write(f"Failed to copy file: {file_info.filename}: {e}")
-                            pass
-            os.remove(tmp_file)
-            return fixed_file_path
-        else:
-            return None
-    except Exception as e:
-        tqdm.write(f"Failed to fix zip file: {file_path}: {e}")
-        return None
+        with ThreadPoolExecutor(max_workers=1) as writer_executor:
+            writer = writer_executor.submit(write_zip_from_queue, temp_zip_file, compresslevel, files_queue)
+            try:
+                kept = filter_files(files_queue)
+            finally:
+                files_queue.put(None)
+                for own_zip_ref in own_handles:
+                    own_zip_ref.close()
+            writer.result()
+        if kept:
+            os.replace(temp_zip_file, output_zip_file)
+    finally:
+        if os.path.exists(temp_zip_file):
+            os.remove(temp_zip_file)
+
+    shutil.rmtree(tmp_folder)
+    return kept
+
+worker_options = {}
+
+def init_worker(route_types_to_keep, files_to_include, compresslevel, start_date, end_date, inner_threads, preload):
+    """Store the options shared by every ZIP once per worker, instead of passing them with each task."""
+    worker_options.update(route_types_to_keep=route_types_to_keep, files_to_include=files_to_include,
+                          compresslevel=compresslevel, start_date=start_date, end_date=end_date,
+                          inner_threads=inner_threads, preload=preload)
+
+def filter_one_zip(zip_file_path, output_zip_file):
+    return filter_gtfs_by_route_type(zip_file_path, output_zip_file, **worker_options)
 
 parser = argparse.ArgumentParser(description='Filter GTFS ZIP files by route type and date, remove duplicates, and fixing corrupted files.')
 parser.add_argument('input', type=str, help='Folder or file path with GTFS ZIPs')
 parser.add_argument('--output_folder', type=str, help='Destination folder for output ZIPs')
 parser.add_argument('--route_types', type=int, nargs='+', default=rail_services, help='Route types to retain')
 parser.add_argument('--files', type=str, nargs='+', default=FILES_TO_INCLUDE, help='Files to include in the output ZIP')
-parser.add_argument('--compresslevel', type=int, default=9, choices=range(1, 10), help='ZIP compression level')
+parser.add_argument('--compresslevel', type=int, default=6, choices=range(1, 10), help='ZIP compression level (default: 6)')
 parser.add_argument('--startdate', type=str, help='Start date (YYYYMMDD)')
 parser.add_argument('--enddate', type=str, help='End date (YYYYMMDD)')
+parser.add_argument('--deep-check', action='store_true', help='Also verify the CRC of every member when checking ZIPs (slow)')
+parser.add_argument('--inner-threads', type=int, default=1, help='Threads filtering independent files within each ZIP (default: 1)')
+parser.add_argument('--preload', action='store_true', help='Read each ZIP into the page cache in one go before filtering it (Linux)')
 args = parser.parse_args()
+args.files = frozenset(args.files)  # Checked once per filtered file
 
 if os.path.isdir(args.input):
     if not args.output_folder:
@@ -259,7 +586,7 @@ if os.path.isdir(args.input):
     else:
         OUTPUT_DIR = args.output_folder
     os.makedirs(OUTPUT_DIR, exist_ok=True)
-    gtfs_files = [os.path.join(args.input, f) for f in os.listdir(args.input) if f.endswith('.zip')]
+    gtfs_files = [entry.path for entry in os.scandir(args.input) if entry.name.endswith('.zip') and entry.is_file()]
     gtfs_files = interleave_round_robin(gtfs_files)
 else:
     gtfs_files = [args.input]
@@ -277,19 +604,22 @@ if start_date and end_date:
 
 print(f'Filtering the following route types: {args.route_types}')
 
-max_workers = os.cpu_count()
+# Decompression, compression, file I/O and the Arrow kernels release the GIL, so threads keep
+# the cores busy without forking workers or pickling arguments and results
+max_workers = (os.cpu_count() or 1) * 2
 unique_files = {}
 valid_files = []
 tmp_dir = "tmp"
-with ProcessPoolExecutor(max_workers=max_workers) as executor:
+with ThreadPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                        initargs=(args.route_types, args.files, args.compresslevel, start_date, end_date, args.inner_threads, args.preload)) as executor:
     futures = []
     for file_path in tqdm(gtfs_files, desc='Checking GTFS files', position=0, leave=True):
-        result = quick_check(file_path)
+        result = quick_check(file_path, args.deep_check)
         if not result:
             tqdm.write(f"Invalid zip file: {file_path}")
             new_file_path = attempt_fix_zip(file_path, tmp_dir)
             if new_file_path:
-                result = quick_check(new_file_path)
+                result = quick_check(new_file_path, args.deep_check)
             if not result:
                 tqdm.write(f"Failed to fix zip file: {file_path}")
                 if OUTPUT_DIR == args.input:
@@ -299,7 +629,7 @@ with ProcessPoolExecutor(max_workers=max_workers) as executor:
                 tqdm.write(f"Fixed zip file: {file_path}")
                 file_path = new_file_path
         if result not in unique_files:
-            futures.append(executor.submit(filter_gtfs_by_route_type, file_path, os.path.join(OUTPUT_DIR, os.path.basename(file_path)), args.route_types, args.files, args.compresslevel, start_date, end_date))
+            futures.append(executor.submit(filter_one_zip, file_path, os.path.join(OUTPUT_DIR, os.path.basename(file_path))))
             unique_files[result] = file_path
             valid_files.append(file_path)
         else:
@@ -311,4 +641,4 @@ with ProcessPoolExecutor(max_workers=max_workers) as executor:
         if not result and OUTPUT_DIR == args.input:
             os.remove(os.path.join(OUTPUT_DIR, os.path.basename(file_path)))
 
-shutil.rmtree(tmp_dir)
\ No newline at end of file
+shutil.rmtree(tmp_dir, ignore_errors=True)  # Only created when a ZIP needed repairing
\ No newline at end of file
@@ -4,68 +4,27 @@ import os
 import time
 import zipfile
 import csv
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
-import subprocess
+from gtfs_utils import quick_check, interleave_round_robin, attempt_fix_zip
 
-all_stations = set()
-def quick_check(file_path):
-    """Perform a quick comparison using size and CRC32."""
-    crc32s = []
-    try:
-        with zipfile.ZipFile(file_path, 'r') as zip_file:
-            for file_info in sorted(zip_file.infolist(), key=lambda x: x.filename):
-                crc32s.append((file_info.filename, file_info.CRC))
-                with zip_file.open(file_info.filename) as _:
-                    pass
-        return tuple(crc32s)  # Immutable tuple as hash key
-    except Exception:
-        return None
-
-def interleave_round_robin(files):
-    sorted_files = sorted(files, key=lambda x: os.stat(x).st_size)
-    n = len(sorted_files)
-    very_large, large = sorted_files[3 * n // 4:], sorted_files[n // 2:3 * n // 4]
-    medium, small = sorted_files[n // 4:n // 2], sorted_files[:n // 4]
-
-    interleaved = []
-    while any([very_large, large, medium, small]):
-        if very_large: interleaved.append(very_large.pop())
-        if small: interleaved.append(small.pop())
-        if large: interleaved.append(large.pop())
-        if medium: interleaved.append(medium.pop())
-
-    return interleaved
-
-def attempt_fix_zip(file_path, tmp_dir="tmp"):
-    """Attempt to fix a corrupted zip file using the zip -FF command and remove problematic files."""
-    os.makedirs(tmp_dir, exist_ok=True)
-    try:
-        tmp_file = os.path.join(tmp_dir, os.path.basename(file_path).split('.')[0] + '_tmp.zip')
-        fixed_file_path = os.path.join(tmp_dir, os.path.basename(file_path))
-        result = subprocess.run(['zip', '-FF', file_path, '--out', tmp_file], input='y\n', capture_output=True, text=True)
-        if result.returncode == 0:
-            with zipfile.ZipFile(tmp_file, 'r') as in_zip:
-                with zipfile.ZipFile(fixed_file_path, 'w') as out_zip:
-                    for file_info in in_zip.infolist():
-                        try:
-                            with in_zip.open(file_info.filename) as infile:
-                                out_zip.writestr(file_info, infile.read())
-                        except Exception as e:
-                            tqdm.write(f"Failed to copy file: {file_info.filename}: {e}")
-                            pass
-            os.remove(tmp_file)
-            return fixed_file_path
-        else:
-            return None
-    except Exception as e:
-        tqdm.write(f"Failed to fix zip file: {file_path}: {e}")
-        return None
+MAX_END_DATE = datetime(2050, 1, 1).date()  # Later end dates are placeholders for "no end"
 
 def analyse_zip_file(zip_file_path):
     """Analyse GTFS files inside a ZIP archive."""
+    # Feeds repeat a few hundred distinct dates over many rows, so each is parsed only once
+    date_cache = {}
+    def parse_date(value):
+        parsed = date_cache.get(value)
+        if parsed is None:
+            parsed = date_cache[value] = datetime(int(value[:4]), int(value[4:6]), int(value[6:8])).date()
+        return parsed
+
     route_types, start_date, end_date = set(), None, None
+    stations = np.empty((0, 2))
     bbox = [float('inf'), float('inf'), float('-inf'), float('-inf')]
     gtfs_files = []
     gtfs_files_sizes = {}
@@ -76,40 +35,58 @@ def analyse_zip_file(zip_file_path):
                 continue
             gtfs_files.append(file_info.filename)
             gtfs_files_sizes[file_info.filename] = file_info.file_size
+            if file_info.filename not in ('routes.txt', 'calendar_dates.txt', 'calendar.txt', 'stops.txt'):
+                continue
             with zip_ref.open(file_info.filename) as infile:
-                reader = csv.DictReader(TextIOWrapper(infile, encoding='utf-8-sig', errors='replace'))
+                if file_info.filename == 'stops.txt':
+                    # Only the two coordinate columns are parsed, straight into arrays
+                    stops = pd.read_csv(infile, encoding='utf-8-sig', encoding_errors='replace', dtype=str,
+                                        usecols=lambda col: col.strip() in ('stop_lat', 'stop_lon'))
+                    stops.columns = stops.columns.str.strip()
+                    if {'stop_lat', 'stop_lon'} <= set(stops.columns):
+                        stations = (stops[['stop_lat', 'stop_lon']].apply(pd.to_numeric, errors='coerce')
+                                    .dropna().to_numpy(dtype=np.float64))
+                    if len(stations):
+                        (min_lat, min_lon), (max_lat, max_lon) = stations.min(axis=0), stations.max(axis=0)
+                        bbox = [float(min_lat), float(min_lon), float(max_lat), float(max_lon)]
+                    continue
+
+                # Rows are indexed by column position instead of building a dict per row
+                reader = csv.reader(TextIOWrapper(infile, encoding='utf-8-sig', errors='replace'))
+                header = [col.strip() for col in next(reader, [])]
+                def column_index(name):
+                    return header.index(name) if name in header else None
+                def get(row, idx):
+                    return row[idx] if idx is not None and idx < len(row) else None
+
                 if file_info.filename == 'routes.txt':
+                    route_type_idx = column_index('route_type')
                     for row in reader:
-                        route_types.add(row.get('route_type'))
+                        if row:
+                            route_types.add(get(row, route_type_idx))
                 elif file_info.filename == 'calendar_dates.txt':
+                    date_idx = column_index('date')
                     for row in reader:
-                        date_str = row.get('date')
+                        date_str = get(row, date_idx)
                         if date_str:
-                            date = datetime.strptime(date_str, "%Y%m%d").date()
+                            date = parse_date(date_str)
                             if start_date is None or date < start_date:
                                 start_date = date
                             if end_date is None or date > end_date:
-                                if date < datetime(2050, 1, 1).date():
+                                if date < MAX_END_DATE:
                                     end_date = date
                 elif file_info.filename == 'calendar.txt':
+                    start_date_idx, end_date_idx = column_index('start_date'), column_index('end_date')
                     for row in reader:
-                        start_date_str, end_date_str = row.get('start_date'), row.get('end_date')
+                        start_date_str, end_date_str = get(row, start_date_idx), get(row, end_date_idx)
                         if start_date_str and end_date_str:
-                            start_date_date = datetime.strptime(start_date_str.strip(), "%Y%m%d").date()
-                            end_date_date = datetime.strptime(end_date_str.strip(), "%Y%m%d").date()
+                            start_date_date = parse_date(start_date_str.strip())
+                            end_date_date = parse_date(end_date_str.strip())
                             if start_date is None or start_date_date < start_date:
                                 start_date = start_date_date
                             if end_date is None or end_date_date > end_date:
-                                if end_date_date < datetime(2050, 1, 1).date():
+                                if end_date_date < MAX_END_DATE:
                                     end_date = end_date_date
-                elif file_info.filename == 'stops.txt':
-                    for row in reader:
-                        stop_lat, stop_lon = row.get('stop_lat'), row.get('stop_lon')
-                        if stop_lat and stop_lon:
-                            lat, lon = float(stop_lat), float(stop_lon)
-                            all_stations.add((lat, lon))
-                            bbox[0], bbox[1] = min(bbox[0], lat), min(bbox[1], lon)
-                            bbox[2], bbox[3] = max(bbox[2], lat), max(bbox[3], lon)
 
     return {
         'route_types': list(route_types),
@@ -117,7 +94,9 @@ def analyse_zip_file(zip_file_path):
         'end_date': end_date,
         'bbox': bbox,
         'gtfs_files': gtfs_files,
-        'gtfs_files_sizes': gtfs_files_sizes
+        'gtfs_files_sizes': gtfs_files_sizes,
+        # Returned to the parent process: a set filled inside the worker would never reach it
+        'stations': stations
     }
 
 def log_statistics(log_file, stats):
@@ -143,25 +122,27 @@ def log_statistics(log_file, stats):
 parser = argparse.ArgumentParser(description='Clean up the zip files by removing unwanted route types')
 parser.add_argument('input', type=str, help='Path to folder or file containing the zip files')
 parser.add_argument('--logging_file', type=str, default='gtfs_file_info.csv', help='Path to the logging CSV file')
+parser.add_argument('--deep-check', action='store_true', help='Also verify the CRC of every member when checking ZIPs (slow)')
 
 args = parser.parse_args()
 
-gtfs_files = [os.path.join(args.input, f) for f in os.listdir(args.input) if f.endswith('.zip')]
+gtfs_files = [entry.path for entry in os.scandir(args.input) if entry.name.endswith('.zip') and entry.is_file()]
 gtfs_files = interleave_round_robin(gtfs_files)
 max_workers = os.cpu_count()
 unique_files, valid_files, fixed_files = {}, [], []
+station_arrays = []
 
 tmp_dir = "tmp"
 with ProcessPoolExecutor(max_workers=max_workers) as executor:
     futures = []
     for file_path in tqdm(gtfs_files, desc='Checking GTFS files', position=0, leave=True):
-        result = quick_check(file_path)
+        result = quick_check(file_path, args.deep_check)
         if not result:
             tqdm.write(f"Invalid zip file: {file_path}")
             fixed_file_path = attempt_fix_zip(file_path, tmp_dir)
             if fixed_file_path:
                 tqdm.write(f"Fixed zip file: {file_path}")
-                result = quick_check(fixed_file_path)
+                result = quick_check(fixed_file_path, args.deep_check)
             if not result:
                 tqdm.write(f"Failed to fix zip file: {file_path}")
                 log_statistics(args.logging_file, {
@@ -200,6 +181,7 @@ with ProcessPoolExecutor(max_workers=max_workers) as executor:
             })
     for future, file_path in tqdm(zip(futures, valid_files), desc='Processing GTFS files', position=0, leave=True, total=len(futures)):
         stats = future.result()
+        station_arrays.append(stats.pop('stations'))
         stats.update({
             'filename': os.path.basename(file_path),
             'duplicate_file': None,
@@ -208,6 +190,7 @@ with ProcessPoolExecutor(max_workers=max_workers) as executor:
         })
         log_statistics(args.logging_file, stats)
 
-with open('all_stations.txt', 'w') as f:
-    for lat, lon in sorted(all_stations):
-        f.write(f"{lat},{lon}\n")
\ No newline at end of file
+# Deduplicate on a 1e-6 degree integer grid; np.unique also returns them sorted by (lat, lon)
+all_stations = np.round(np.vstack(station_arrays or [np.empty((0, 2))]) * 1e6).astype(np.int32)
+all_stations = np.unique(all_stations, axis=0)
+np.savetxt('all_stations.txt', all_stations / 1e6, fmt='%.6f', delimiter=',')
\ No newline at end of file
@@ -1,13 +1,22 @@
 import networkx as nx
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 import zipfile
 import os
 import glob
-import shutil
+import io
 import argparse
+import numpy as np
+import pandas as pd
 import csv
 
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+
 rail_services = [
     2,    # Rail (intercity or long-distance)
     100,  # Railway Service
@@ -99,12 +108,56 @@ else:
     gtfs_files = [file for file in os.listdir(DATA_DIR) if file not in ignore_gtfs_zips and file.endswith('.zip')]
 gtfs_files = interleave_round_robin(gtfs_files)
 
+def read_gtfs_csv(data, columns, keep=None):
+    """
+    Read the given columns of a GTFS file, given as bytes, as whitespace-stripped strings.
+    Header names are matched after stripping; a missing column raises an exception.
+    Uses the multi-threaded PyArrow parser when available, and pandas otherwise or
+    for files PyArrow rejects (e.g. not UTF-8).
+    If `keep` is a (column, values) pair, only rows whose stripped column value is in
+    `values` are returned; with PyArrow, the other rows never become Python objects.
+    """
+    header_line = data.split(b'\n', 1)[0].decode('utf-8-sig', errors='replace')
+    raw_names = {col.strip(): col for col in next(csv.reader([header_line]), [])}
+    missing = [col for col in columns if col not in raw_names]
+    if missing:
+        raise Exception(f"Missing columns: {missing}")
+    raw_columns = [raw_names[col] for col in columns]
+
+    if pa is not None:
+        try:
+            table = pa_csv.read_csv(pa.BufferReader(data), convert_options=pa_csv.ConvertOptions(
+                include_columns=raw_columns, column_types={col: pa.string() for col in raw_columns},
+                strings_can_be_null=False
+            ))
+            # Trimmed and filtered in Arrow, before any Python string is created
+            table = pa.table({col: pc.utf8_trim_whitespace(table.column(raw))
+                              for col, raw in zip(columns, raw_columns)})
+            if keep is not None:
+                keep_column, keep_values = keep
+                table = table.filter(pc.is_in(table.column(keep_column), value_set=pa.array(list(keep_values), pa.string())))
+            return table.to_pandas()
+        except pa.ArrowException:
+            pass
+    df = pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False, encoding='utf-8-sig', usecols=raw_columns)
+    df.columns = df.columns.str.strip()
+    df = df[columns].apply(lambda col: col.str.strip())
+    if keep is not None:
+        keep_column, keep_values = keep
+        df = df[df[keep_column].isin(keep_values)]
+    return df
+
 def process_zip_file(zip_file, include_edges=True):
+    """
+    Build the stops and connections of one GTFS archive as a local subgraph.
+    Returns (nodes, edges) in the format of add_nodes_from/add_edges_from, or None if the
+    archive should be ignored. Runs in a worker process, so it must not touch the global graph.
+    """
     if not zip_file.endswith('.zip') or zip_file in ignore_gtfs_zips:
-        return
-    extract_dir = os.path.join(DATA_DIR, zip_file.split('.')[0])
+        return None
     try:
-        files_to_unzip = []
+        # Members are decompressed into memory and parsed from there, never written to disk
+        contents = {}
         with zipfile.ZipFile(os.path.join(DATA_DIR, zip_file), 'r') as zip_ref:
             for file in FILES_TO_EXTRACT:
                 corresponding_files = [f for f in zip_ref.namelist() if f == file or f.endswith('/' + file)]
@@ -112,157 +165,98 @@ def process_zip_file(zip_file, include_edges=True):
                     raise Exception(f"Missing file: {file}")
                 elif len(corresponding_files) > 1:
                     raise Exception(f"Multiple files found: {corresponding_files}")
-                files_to_unzip.append(corresponding_files[0])
-
-            zip_ref.extractall(extract_dir, files_to_unzip)
-        contents = os.listdir(extract_dir)
-        if len(contents) == 1 and os.path.isdir(os.path.join(extract_dir, contents[0])):
-            inner_dir = os.path.join(extract_dir, contents[0])
-            for item in os.listdir(inner_dir):
-                shutil.move(os.path.join(inner_dir, item), os.path.join(extract_dir, item))
-            os.rmdir(inner_dir)
+                contents[file] = zip_ref.read(corresponding_files[0])
     except Exception as e:
         if isinstance(e, KeyboardInterrupt):
             raise e
         tqdm.write(f"Error extracting {zip_file}: {e}")
-        ignore_gtfs_zips.add(zip_file)
-        shutil.rmtree(extract_dir, ignore_errors=True)
-        return
+        return None
     try:
-        with open(os.path.join(extract_dir, 'routes.txt'), 'r', encoding="utf-8-sig") as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            # route_id_idx = header.index('route_id')
-            # route_type_idx = header.index('route_type')
-            for i, h in enumerate(header):
-                if h.strip() == 'route_type':
-                    route_type_idx = i
-                elif h.strip() == 'route_id':
-                    route_id_idx = i
-
-            # routes = {row[route_id_idx] for row in reader if row and int(row[route_type_idx]) in args.route_types}
-            routes = set()
-            for row in reader:
-                stripped_route_id = row[route_id_idx].strip()
-                if row and int(row[route_type_idx]) in args.route_types and stripped_route_id:
-                    routes.add(stripped_route_id)
-
-        if not routes:
+        routes = read_gtfs_csv(contents.pop('routes.txt'), ['route_id', 'route_type'])
+        route_types = pd.to_numeric(routes['route_type'], errors='coerce')
+        routes = routes.loc[route_types.isin(args.route_types) & (routes['route_id'] != ''), 'route_id']
+
+        if routes.empty:
             raise Exception("No routes found")
 
-        with open(os.path.join(extract_dir, 'trips.txt'), 'r', encoding="utf-8-sig") as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            # route_id_idx = header.index('route_id')
-            # trip_id_idx = header.index('trip_id')
-            for i, h in enumerate(header):
-                if h.strip() == 'route_id':
-                    route_id_idx = i
-                elif h.strip() == 'trip_id':
-                    trip_id_idx = i
-            # trips = {row[trip_id_idx] for row in reader if row and row[route_id_idx] in routes}
-            trips = set()
-            for row in reader:
-                stripped_trip_id = row[trip_id_idx].strip()
-                if row and row[route_id_idx] in routes and stripped_trip_id:
-                    trips.add(stripped_trip_id)
+        trips = read_gtfs_csv(contents.pop('trips.txt'), ['route_id', 'trip_id'])
+        trips = trips.loc[trips['route_id'].isin(routes) & (trips['trip_id'] != ''), 'trip_id']
 
         del routes
 
-        if not trips:
+        if trips.empty:
             raise Exception("No trips found")
 
-        with open(os.path.join(extract_dir, 'stop_times.txt'), 'r', encoding="utf-8-sig") as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            # trip_id_idx = header.index('trip_id')
-            # stop_id_idx = header.index('stop_id')
-            # stop_sequence_idx = header.index('stop_sequence')
-            for i, h in enumerate(header):
-                if h.strip() == 'trip_id':
-                    trip_id_idx = i
-                elif h.strip() == 'stop_id':
-                    stop_id_idx = i
-                elif h.strip() == 'stop_sequence':
-                    stop_sequence_idx = i
-
-            stop_times = {}
-            stops = set()
-
-            for row in reader:
-                if row:
-                    trip_id = row[trip_id_idx].strip()
-                    if trip_id in trips:
-                        stop_id = row[stop_id_idx].strip()
-                        stops.add(stop_id)
-                        stop_sequence = int(row[stop_sequence_idx])
-                        if trip_id not in stop_times:
-                            stop_times[trip_id] = []
-                        stop_times[trip_id].append((stop_id, stop_sequence))
+        stop_times = read_gtfs_csv(contents.pop('stop_times.txt'), ['trip_id', 'stop_id', 'stop_sequence'])
+        stop_times = stop_times[stop_times['trip_id'].isin(trips)]
+        stop_times = stop_times.assign(stop_sequence=stop_times['stop_sequence'].astype('int64'))
+        stops = set(stop_times['stop_id'])
 
         del trips
 
-        for trip_id in stop_times:
-            stop_times[trip_id].sort(key=lambda x: x[1])
-
-        if not stop_times:
+        if stop_times.empty:
             raise Exception("No stop_times found")
 
-        with open(os.path.join(extract_dir, 'stops.txt'), 'r', encoding="utf-8-sig") as f:
-            reader = csv.reader(f)
-            header = next(reader)
-            # stop_id_idx = header.index('stop_id')
-            # stop_name_idx = header.index('stop_name')
-            # stop_lat_idx = header.index('stop_lat')
-            # stop_lon_idx = header.index('stop_lon')
-            for i, h in enumerate(header):
-                if h.strip() == 'stop_id':
-                    stop_id_idx = i
-                elif h.strip() == 'stop_name':
-                    stop_name_idx = i
-                elif h.strip() == 'stop_lat':
-                    stop_lat_idx = i
-                elif h.strip() == 'stop_lon':
-                    stop_lon_idx = i
-
-            for row in reader:
-                if row:
-                    stop_id = row[stop_id_idx].strip()
-                    if stop_id in stops:
-                        G.add_node(stop_id, name=row[stop_name_idx], lat=float(row[stop_lat_idx]), lon=float(row[stop_lon_idx]))
+        stops_df = read_gtfs_csv(contents.pop('stops.txt'), ['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+                                 keep=('stop_id', stops))
+        nodes = {}
+        for stop_id, stop_name, stop_lat, stop_lon in stops_df[['stop_id', 'stop_name', 'stop_lat', 'stop_lon']].itertuples(index=False, name=None):
+            nodes[stop_id] = {'name': stop_name, 'lat': float(stop_lat), 'lon': float(stop_lon)}
 
+        edges = []
         if include_edges:
-            for trip_id, stop_time in stop_times.items():
-                for (stop1, _), (stop2, _) in zip(stop_time, stop_time[1:]):
-                    if stop1 in G and stop2 in G:
-                        G.add_edge(stop1, stop2, trip_id=trip_id)
-                    else:
-                        tqdm.write(f"Missing nodes in file {zip_file}: {stop1}, {stop2}")
+            # One sort of all rows by (trip, stop_sequence), on integer trip codes in order of first
+            # appearance; each stop is then connected to the next row if it belongs to the same trip
+            trip_codes, _ = pd.factorize(stop_times['trip_id'])
+            order = np.lexsort((stop_times['stop_sequence'].to_numpy(), trip_codes))
+            same_trip = trip_codes[order][1:] == trip_codes[order][:-1]
+
+            stop_ids = stop_times['stop_id'].to_numpy()[order]
+            is_node = stop_times['stop_id'].isin(set(nodes)).to_numpy()[order]
+            stop1, stop2 = stop_ids[:-1][same_trip], stop_ids[1:][same_trip]
+            trip_ids = stop_times['trip_id'].to_numpy()[order][1:][same_trip]
+            known = is_node[:-1][same_trip] & is_node[1:][same_trip]
+
+            for missing1, missing2 in zip(stop1[~known], stop2[~known]):
+                tqdm.write(f"Missing nodes in file {zip_file}: {missing1}, {missing2}")
+            edges = [(a, b, {'trip_id': trip_id}) for a, b, trip_id in zip(stop1[known], stop2[known], trip_ids[known])]
         
         del stop_times, stops
+
+        return list(nodes.items()), edges
         
     except Exception as e:
         if isinstance(e, KeyboardInterrupt):
             raise e
         tqdm.write(f"Error processing {zip_file}: {e}")
-        ignore_gtfs_zips.add(zip_file)
-    finally:
-        shutil.rmtree(extract_dir, ignore_errors=True)
+        return None
 
 max_workers = os.cpu_count()
-with ThreadPoolExecutor(max_workers=max_workers) as executor:
-    list(tqdm(executor.map(lambda zip_file: process_zip_file(zip_file, include_edges=True), gtfs_files), desc='Processing GTFS files', position=0, leave=True, total=len(gtfs_files)))
+# Parsing is partly pure Python, so each archive is handled in its own process and
+# the subgraphs are merged here in bulk, in submission order
+with ProcessPoolExecutor(max_workers=max_workers) as executor:
+    results = executor.map(process_zip_file, gtfs_files)
+    for zip_file, result in tqdm(zip(gtfs_files, results), desc='Processing GTFS files', position=0, leave=True, total=len(gtfs_files)):
+        if result is None:
+            ignore_gtfs_zips.add(zip_file)
+            continue
+        nodes, edges = result
+        G.add_nodes_from(nodes)
+        G.add_edges_from(edges)
 
 with open(args.ignore_gtfs_zips, 'w') as f:
     f.write('\n'.join(ignore_gtfs_zips))
 
 if args.remove_incorrect_nodes:
-    nodes_to_remove = [node for node in G.nodes if 'lat' not in G.nodes[node] or 'lon' not in G.nodes[node] or G.nodes[node]['lat'] == 0 or G.nodes[node]['lon'] == 0]
+    # Attributes are gathered once; nodes missing either coordinate are removed too
+    lats = nx.get_node_attributes(G, 'lat')
+    lons = nx.get_node_attributes(G, 'lon')
+    nodes_to_remove = [node for node in G.nodes if not lats.get(node) or not lons.get(node)]
     tqdm.write(f"Removing {len(nodes_to_remove)} nodes with incorrect coordinates")
     G.remove_nodes_from(nodes_to_remove)
 import pickle
 with open(args.save_graph_location, 'wb') as f:
-    pickle.dump(G, f)
+    pickle.dump(G, f, protocol=pickle.HIGHEST_PROTOCOL)
 tqdm.write(f"Graph saved to {args.save_graph_location}")
 
 if args.visualise:
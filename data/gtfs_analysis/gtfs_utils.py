@@ -0,0 +1,157 @@
+"""Helpers shared by clean_gtfs_files.py and get_statistics_gtfs.py for checking, ordering and repairing GTFS ZIPs."""
+import os
+import zipfile
+import struct
+import mmap
+import re
+import zlib
+import shutil
+from tqdm import tqdm
+from tempfile import SpooledTemporaryFile
+from functools import lru_cache
+
+MEMBER_KEY = struct.Struct('<III')  # crc32(filename), CRC, size of one member in the quick_check key
+
+@lru_cache(maxsize=256)
+def get_central_dir(file_path, mtime):
+    """
+    The ZipInfo entries of an archive's central directory, as a tuple.
+    mtime is part of the cache key only, so that a rewritten or repaired file is read again.
+    """
+    with zipfile.ZipFile(file_path, 'r') as zip_file:
+        return tuple(zip_file.infolist())
+
+def central_dir(file_path):
+    """get_central_dir for the current version of file_path."""
+    return get_central_dir(file_path, os.stat(file_path).st_mtime_ns)
+
+def quick_check(file_path, deep_check=False):
+    """Perform a quick comparison using size and CRC32 from the central directory.
+
+    Returns a compact bytes key, or None if the archive cannot be read. With deep_check,
+    every member is also decompressed and its CRC verified. The listing is cached, so
+    later steps on the same file can use central_dir without parsing it again.
+    """
+    try:
+        if deep_check:
+            with zipfile.ZipFile(file_path, 'r') as zip_file:
+                if zip_file.testzip() is not None:
+                    return None
+        return b''.join(
+            MEMBER_KEY.pack(zlib.crc32(file_info.filename.encode()), file_info.CRC, file_info.file_size & 0xFFFFFFFF)
+            for file_info in sorted(central_dir(file_path), key=lambda x: x.filename)
+        )
+    except Exception:
+        return None
+
+def interleave_round_robin(files):
+    sorted_files = sorted(files, key=lambda x: os.stat(x).st_size)
+    n = len(sorted_files)
+
+    # Split into quartiles
+    very_large = sorted_files[3 * n // 4:]
+    large = sorted_files[n // 2:3 * n // 4]
+    medium = sorted_files[n // 4:n // 2]
+    small = sorted_files[:n // 4]
+
+    interleaved = []
+    while any([very_large, large, medium, small]):
+        if very_large:
+            interleaved.append(very_large.pop())
+        if small:
+            interleaved.append(small.pop())
+        if large:
+            interleaved.append(large.pop())
+        if medium:
+            interleaved.append(medium.pop())
+
+    return interleaved
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+COPY_CHUNK_SIZE = 1 << 20
+
+def read_local_entry(mm, offset, spool):
+    """
+    Decompress the member whose local header starts at `offset` into `spool`, checking its CRC.
+    Returns (ZipInfo, offset after the member), or None if it is damaged or unsupported.
+    """
+    (_, _, flags, method, mtime, mdate, crc, compressed_size, _,
+     name_length, extra_length) = LOCAL_HEADER.unpack_from(mm, offset)
+    has_descriptor = bool(flags & 0x08)  # Sizes and CRC follow the data instead
+    if flags & 0x01 or method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        return None  # Encrypted or unsupported compression
+    if has_descriptor and method == zipfile.ZIP_STORED:
+        return None  # The end of stored data cannot be found without its size
+
+    name_start = offset + LOCAL_HEADER.size
+    name = mm[name_start:name_start + name_length].decode('utf-8' if flags & 0x800 else 'cp437')
+    position = data_start = name_start + name_length + extra_length
+    end = len(mm) if has_descriptor else data_start + compressed_size
+    if end > len(mm):
+        return None  # Truncated
+
+    decompressor = zlib.decompressobj(-15) if method == zipfile.ZIP_DEFLATED else None
+    running_crc = 0
+    while position < end and not (decompressor and decompressor.eof):
+        chunk = mm[position:min(position + COPY_CHUNK_SIZE, end)]
+        position += len(chunk)
+        data = decompressor.decompress(chunk) if decompressor else chunk
+        running_crc = zlib.crc32(data, running_crc)
+        spool.write(data)
+    if decompressor:
+        if not decompressor.eof:
+            return None
+        position -= len(decompressor.unused_data)
+    if has_descriptor:
+        if mm[position:position + 4] == DATA_DESCRIPTOR_SIGNATURE:
+            position += 4
+        crc = struct.unpack_from('<I', mm, position)[0]
+        position += 12
+    if running_crc != crc:
+        return None
+
+    date_time = ((mdate >> 9) + 1980, (mdate >> 5) & 0x0F, mdate & 0x1F,
+                 mtime >> 11, (mtime >> 5) & 0x3F, (mtime & 0x1F) * 2)
+    info = zipfile.ZipInfo(name, date_time)
+    info.compress_type = method
+    return info, position
+
+def attempt_fix_zip(file_path, tmp_dir="tmp"):
+    """
+    Attempt to fix a corrupted zip file by rebuilding it from its local file headers,
+    which survive a missing or truncated central directory. Members failing their
+    CRC check are dropped.
+    """
+    os.makedirs(tmp_dir, exist_ok=True)
+    fixed_file_path = os.path.join(tmp_dir, os.path.basename(file_path))
+    try:
+        recovered, next_offset = set(), 0
+        with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                zipfile.ZipFile(fixed_file_path, 'w') as out_zip:
+            for match in re.finditer(re.escape(LOCAL_HEADER_SIGNATURE), mm):
+                if match.start() < next_offset:
+                    continue  # Signature bytes inside a member that was already recovered
+                # Members are checked before being added, spilling to disk only when large
+                with SpooledTemporaryFile(max_size=64 << 20) as spool:
+                    try:
+                        entry = read_local_entry(mm, match.start(), spool)
+                    except (zlib.error, struct.error, UnicodeDecodeError):
+                        entry = None
+                    if entry is None or entry[0].filename in recovered:
+                        continue
+                    info, next_offset = entry
+                    info.file_size = spool.tell()
+                    spool.seek(0)
+                    with out_zip.open(info, 'w') as outfile:
+                        shutil.copyfileobj(spool, outfile, COPY_CHUNK_SIZE)
+                    recovered.add(info.filename)
+
+        if recovered:
+            return fixed_file_path
+        os.remove(fixed_file_path)
+        return None
+    except Exception as e:
+        tqdm.write(f"Failed to fix zip file: {file_path}: {e}")
+        return None
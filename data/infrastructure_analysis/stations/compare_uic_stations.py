@@ -2,11 +2,13 @@ import argparse
 import glob
 import json
 import os
+import numpy as np
 import pandas as pd
-from scipy.spatial import cKDTree
+from sklearn.neighbors import BallTree
 import geopandas as gpd
 import matplotlib.pyplot as plt
-from tqdm import tqdm
+
+EARTH_RADIUS_M = 6_371_000
 
 
 def load_trainline(path):
@@ -27,42 +29,34 @@ def load_osm_latest(osm_dir):
     with open(osm_file, "r", encoding="utf-8") as f:
         osm_data = json.load(f)
 
-    osm_rows, ignored_count = [], 0
+    osm_rows = []
     for cc, data in osm_data.items():
         for el in data.get("elements", []):
             tags = el.get("tags", {})
-            if any("abandoned" in str(k).lower() or "disused" in str(k).lower() or
-                   "abandoned" in str(v).lower() or "disused" in str(v).lower()
-                   for k, v in tags.items()):
-                ignored_count += 1
-                continue
-
-            lat, lon = (el["lat"], el["lon"]) if el["type"] == "node" else el.get("center", {}).get("lat"), el.get("center", {}).get("lon")
-            if lat is None or lon is None:
-                continue
-
+            position = el if el["type"] == "node" else el.get("center", {})
             osm_rows.append({
                 "source": "OSM",
                 "name": tags.get("name", ""),
-                "latitude": lat,
-                "longitude": lon,
-                "uic": tags.get("uic_ref", "")
+                "latitude": position.get("lat"),
+                "longitude": position.get("lon"),
+                "uic": tags.get("uic_ref", ""),
+                # All keys and values in one string, so that they are searched in a single regex pass
+                "tag_blob": "\n".join(f"{k}={v}" for k, v in tags.items())
             })
 
-    print(f"Ignored {ignored_count} items with 'abandoned' or 'disused' tags or values.")
-    return pd.DataFrame(osm_rows)
+    df = pd.DataFrame(osm_rows, columns=["source", "name", "latitude", "longitude", "uic", "tag_blob"])
+    ignored = df["tag_blob"].str.contains("abandoned|disused", case=False, regex=True, na=False)
+    print(f"Ignored {int(ignored.sum())} items with 'abandoned' or 'disused' tags or values.")
+    df = df[~ignored].drop(columns="tag_blob")
+    return df.dropna(subset=["latitude", "longitude"]).reset_index(drop=True)
 
 
 def load_wikidata(wd_dir):
-    frames = []
-    for fn in os.listdir(wd_dir):
-        if fn.endswith(".csv"):
-            df = pd.read_csv(os.path.join(wd_dir, fn))
-            frames.append(df)
+    frames = [pd.read_csv(os.path.join(wd_dir, fn)) for fn in os.listdir(wd_dir) if fn.endswith(".csv")]
 
     df = pd.concat(frames, ignore_index=True)
-    df["lon"] = df["Coordinates"].str.extract(r"Point\(([^ ]+) ")[0].astype(float)
-    df["lat"] = df["Coordinates"].str.extract(r" ([^ ]+)\)")[0].astype(float)
+    # Both coordinates from a single pass of the regex
+    df[["lon", "lat"]] = df["Coordinates"].str.extract(r"Point\(([^ ]+) ([^ ]+)\)").astype(float)
 
     df = df.rename(columns={"Station": "name", "UIC Code": "uic", "IBNR ID": "db_id"})
     df = df.dropna(subset=["lat", "lon"]).rename(columns={"lat": "latitude", "lon": "longitude"})
@@ -77,54 +71,47 @@ def load_wikidata(wd_dir):
     return df
 
 
-def classify_matches(df, train_coords, train_uic, train_db_id, df_train):
-    tree = cKDTree(train_coords)
+def classify_matches(df, train_coords, train_uic, train_uic_set, train_db_id, df_train):
+    # Great-circle distances on (lat, lon) in radians, so the 500 m radius holds at every latitude
+    tree = BallTree(np.radians(train_coords), metric="haversine")
     coords = df[["latitude", "longitude"]].to_numpy()
-    distance_upper_bound = 500 / 111_319.9  # Convert 500 meters to degrees
-
-    dists, idxs = tree.query(coords, k=7, distance_upper_bound=distance_upper_bound)
-    results = []
-
-    for i, (dist_list, idx_list) in tqdm(enumerate(zip(dists, idxs)), total=len(dists)):
-        src_uic = str(df.iloc[i]["uic"])
-        matched = None
-        category = None
-
-        for dist, idx in zip(dist_list, idx_list):
-            if idx == len(train_uic):
-                continue
-            if src_uic and src_uic == train_uic[idx]:
-                matched, category = idx, "same_uic"
-                break
-
-        if matched is None:
-            for dist, idx in zip(dist_list, idx_list):
-                if idx == len(train_uic):
-                    continue
-                if src_uic and train_db_id[idx] and src_uic == train_db_id[idx]:
-                    matched, category = idx, "uic_equals_db_id"
-                    break
-
-        if matched is None and idx_list[0] != len(train_uic):
-            matched = idx_list[0]
-            category = "no_uic" if not src_uic else "non_matching_uic"
-
-        if matched is None:
-            category = "unmatched_no_uic" if not src_uic else (
-                "unmatched_uic_exists_elsewhere" if src_uic in train_uic else "unmatched_uic_not_exists"
-            )
-
-        results.append({
-            "matched_idx": matched,
-            "category": category,
-            "dist_m": dist_list[0],
-            "name_diff": (
-                df.iloc[i]["name"],
-                df_train.loc[matched, "name"] if matched is not None and matched in df_train.index else ""
-            )
-        })
-
-    out = pd.DataFrame(results, index=df.index)
+    dists, idxs = tree.query(np.radians(coords), k=min(7, len(train_coords)))
+    dists *= EARTH_RADIUS_M
+
+    # (N, 7) candidate matrices; neighbours further than 500 m are not candidates
+    valid = dists < 500
+    dists[~valid] = np.inf
+    src_uic = df["uic"].astype(str).to_numpy()
+    has_uic = src_uic != ""
+    same_uic = valid & has_uic[:, None] & (train_uic[idxs] == src_uic[:, None])
+    uic_equals_db_id = (valid & has_uic[:, None] & (train_db_id[idxs] != "")
+                        & (train_db_id[idxs] == src_uic[:, None]))
+    has_same_uic, has_uic_equals_db_id = same_uic.any(axis=1), uic_equals_db_id.any(axis=1)
+    has_nearest = valid[:, 0]
+    uic_exists = df["uic"].astype(str).isin(train_uic_set).to_numpy()
+
+    # The closest candidate with the same UIC wins, then one whose DB ID equals the UIC, then the nearest
+    rows = np.arange(len(df))
+    matched = np.select(
+        [has_same_uic, has_uic_equals_db_id, has_nearest],
+        [idxs[rows, same_uic.argmax(axis=1)], idxs[rows, uic_equals_db_id.argmax(axis=1)], idxs[:, 0]],
+        default=-1
+    )
+    category = np.select(
+        [has_same_uic, has_uic_equals_db_id, has_nearest & ~has_uic, has_nearest, ~has_uic, uic_exists],
+        ["same_uic", "uic_equals_db_id", "no_uic", "non_matching_uic", "unmatched_no_uic", "unmatched_uic_exists_elsewhere"],
+        default="unmatched_uic_not_exists"
+    )
+
+    # matched holds positions in the train arrays, not df_train index labels
+    train_names = df_train["name"].to_numpy()
+    matched_names = np.where(matched >= 0, train_names[np.maximum(matched, 0)], "")
+    out = pd.DataFrame({
+        "matched_idx": pd.Series(matched, index=df.index, dtype="Int64").mask(matched < 0),
+        "category": category,
+        "dist_m": dists[:, 0],
+        "name_diff": list(zip(df["name"].to_numpy(), matched_names))
+    }, index=df.index)
     return pd.concat([df, out], axis=1)
 
 
@@ -189,12 +176,14 @@ df_osm = load_osm_latest(args.osm_dir)
 df_wikidata = load_wikidata(args.wikidata_dir)
 
 train_uic = df_train['uic'].to_numpy()
+# Shared by both classifications; stations without a UIC never count as existing
+train_uic_set = set(train_uic.tolist()) - {''}
 train_db_id = df_train['db_id'].to_numpy()
 train_coords = df_train[['latitude', 'longitude']].to_numpy()
 
 # Classify matches
-df_osm = classify_matches(df_osm, train_coords, train_uic, train_db_id, df_train)
-df_wikidata = classify_matches(df_wikidata, train_coords, train_uic, train_db_id, df_train)
+df_osm = classify_matches(df_osm, train_coords, train_uic, train_uic_set, train_db_id, df_train)
+df_wikidata = classify_matches(df_wikidata, train_coords, train_uic, train_uic_set, train_db_id, df_train)
 
 # Load Europe basemap
 world = gpd.read_file("https://naturalearth.s3.amazonaws.com/110m_cultural/ne_110m_admin_0_countries.zip")
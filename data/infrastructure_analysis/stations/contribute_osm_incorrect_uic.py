@@ -1,11 +1,15 @@
 import os
+import re
 import argparse
 import json
 import requests
+from urllib3.util.retry import Retry
+import numpy as np
 import pandas as pd
-from scipy.spatial import cKDTree
-from rapidfuzz import fuzz
+from sklearn.neighbors import BallTree
+from rapidfuzz import fuzz, process
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 
 COUNTRIES = [
@@ -14,6 +18,37 @@ COUNTRIES = [
     "RO", "UA", "TR", "RS", "ME", "BA", "FI", "LI", "AL", "MT", "MD", "EE", "CY"
 ]
 
+EARTH_RADIUS_M = 6_371_000
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+# Upper bound on parallel country queries; lowered to the slots the server grants (usually 2)
+OVERPASS_WORKERS = 4
+OVERPASS_TIMEOUT = (10, 300)  # Connect and read timeouts in seconds
+
+# Shared session: connections are kept alive and reused across country queries.
+# Rate-limited (429) and timed-out (504) queries are retried with exponential backoff,
+# honouring Retry-After, before the error is raised
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(
+    pool_connections=OVERPASS_WORKERS, pool_maxsize=OVERPASS_WORKERS,
+    max_retries=Retry(total=5, status_forcelist=[429, 504], allowed_methods=None, backoff_factor=5, raise_on_status=False)
+))
+
+def get_overpass_slots():
+    """
+    Read the number of concurrent query slots granted by the Overpass server,
+    or None if the status endpoint does not report it.
+    """
+    status_url = OVERPASS_URL.rsplit("/", 1)[0] + "/status"
+    try:
+        response = session.get(status_url, timeout=OVERPASS_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        print(f"Could not read Overpass status: {e}")
+        return None
+    match = re.search(r"Rate limit: (\d+)", response.text)
+    # A rate limit of 0 means the server does not limit slots
+    return (int(match.group(1)) or None) if match else None
+
 def get_overpass_query(cc: str) -> str:
     return f"""
     [out:json];
@@ -28,13 +63,27 @@ def fetch_osm_data(countries, cache_file=None):
         with open(cache_file, "r", encoding="utf-8") as f:
             overpass_results = json.load(f)
     else:
-        overpass_results = {}
-        for cc in tqdm(countries, desc="Fetching OSM data"):
-            query = get_overpass_query(cc)
-            res = requests.post("http://overpass-api.de/api/interpreter", data={"data": query})
-            data = res.json()
-            overpass_results[cc] = data
-        if cache_file:
+        def fetch_country(cc):
+            try:
+                response = session.post(OVERPASS_URL, data={"data": get_overpass_query(cc)}, timeout=OVERPASS_TIMEOUT)
+                response.raise_for_status()
+                return response.json()
+            except (requests.RequestException, ValueError) as e:
+                tqdm.write(f"Failed to fetch OSM data for {cc}: {e}")
+                return None
+
+        slots = get_overpass_slots()
+        workers = min(OVERPASS_WORKERS, slots) if slots else OVERPASS_WORKERS
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(fetch_country, countries)
+            overpass_results = dict(zip(countries, tqdm(results, total=len(countries), desc="Fetching OSM data")))
+
+        # A failed country does not stop the others, but the incomplete results are not cached
+        failed = [cc for cc, data in overpass_results.items() if data is None]
+        overpass_results = {cc: data for cc, data in overpass_results.items() if data is not None}
+        if failed:
+            print(f"Missing OSM data for {', '.join(failed)}; results not cached.")
+        elif cache_file:
             with open(cache_file, "w", encoding="utf-8") as f:
                 json.dump(overpass_results, f, indent=2)
 
@@ -58,23 +107,25 @@ def assign_nuts_regions(df, nuts_file_path):
     if not os.path.exists(nuts_file_path):
         raise FileNotFoundError(f"NUTS file not found: {nuts_file_path}")
     df_nuts = pd.read_csv(nuts_file_path)
-    tree = cKDTree(df_nuts[["latitude", "longitude"]].to_numpy())
+    tree = BallTree(np.radians(df_nuts[["latitude", "longitude"]].to_numpy()), metric="haversine")
     coords = df[["latitude", "longitude"]].to_numpy()
-    _, idxs = tree.query(coords, k=1)
-    df["NUTS_ID"] = df_nuts["NUTS_ID"].iloc[idxs].values
+    _, idxs = tree.query(np.radians(coords), k=1)
+    df["NUTS_ID"] = df_nuts["NUTS_ID"].iloc[idxs[:, 0]].values
     return df
 
 
 def match_stations(df_osm, df_train):
     coords_osm = df_osm[["latitude", "longitude"]].to_numpy()
     coords_train = df_train[["latitude", "longitude"]].to_numpy()
-    tree = cKDTree(coords_train)
-    distances, indices = tree.query(coords_osm)
-
-    name_similarities = [
-        fuzz.ratio(osm_name, df_train.iloc[i]["name"]) / 100
-        for osm_name, i in zip(df_osm["name"], indices)
-    ]
+    # Great-circle distances on (lat, lon) in radians, converted to meters
+    tree = BallTree(np.radians(coords_train), metric="haversine")
+    distances, indices = tree.query(np.radians(coords_osm), k=1)
+    distances, indices = distances[:, 0] * EARTH_RADIUS_M, indices[:, 0]
+
+    # Pairwise (not all-pairs) scores, computed in C on all cores
+    name_similarities = process.cpdist(
+        df_osm["name"].tolist(), df_train["name"].iloc[indices].tolist(), scorer=fuzz.ratio, workers=-1
+    ) / 100
     df_matches = df_osm.copy()
     df_matches["nearest_station_uic"] = df_train["uic"].iloc[indices].values
     df_matches["nearest_station_distance"] = distances
@@ -93,39 +144,49 @@ def filter_mismatches(df_matches, nuts_file=None):
     if nuts_file:
         mismatches = assign_nuts_regions(mismatches, nuts_file)
         mismatches["area_id"] = mismatches["NUTS_ID"].fillna("unknown")
-        mismatches["area_id"] = mismatches["area_id"].apply(
-            lambda x: x[:2] if mismatches["area_id"].value_counts().get(x, 0) < 20 else x
-        )
+        # Regions with fewer than 20 mismatches are grouped by country
+        area_counts = mismatches["area_id"].value_counts()
+        small_areas = mismatches["area_id"].isin(area_counts.index[area_counts < 20])
+        mismatches["area_id"] = mismatches["area_id"].where(~small_areas, mismatches["area_id"].str[:2])
     return mismatches
 
 
-def find_element_by_id(el_id, overpass_data):
+def index_nodes_by_id(overpass_data):
+    """Map node IDs to their Overpass elements; the first occurrence wins for stations listed in several countries."""
+    nodes = {}
     for country_data in overpass_data.values():
         for el in country_data.get("elements", []):
-            if el.get("id") == el_id:
-                return el
-    return None
+            if el.get("type") == "node":
+                nodes.setdefault(el["id"], el)
+    return nodes
 
 
 def generate_osm_xml(mismatches, overpass_data, output_file):
-    root = ET.Element("osm", version="0.6", generator="uic-mismatch-fixer")
-    for _, row in mismatches.iterrows():
-        el = find_element_by_id(row["id"], overpass_data)
-        if not el:
-            continue
-        node = ET.SubElement(root, "node", id=str(int(row["id"])), lat=str(row["latitude"]), lon=str(row["longitude"]), version="1", action="modify")
-        tags = el.get("tags", {})
-        for k, v in tags.items():
-            if k != "uic_ref":
-                ET.SubElement(node, "tag", k=k, v=v)
-        ET.SubElement(node, "tag", k="uic_ref", v=row["nearest_station_uic"])
-        source = tags.get("source", "")
-        source += ";https://github.com/trainline-eu/stations" if source else "https://github.com/trainline-eu/stations"
-        ET.SubElement(node, "tag", k="source", v=source)
-    ET.ElementTree(root).write(output_file, encoding="UTF-8", xml_declaration=True)
+    """
+    Write the corrected nodes as an OSM change file. Each node is serialised and written
+    as soon as it is built, so the whole document is never held in memory.
+    """
+    nodes_by_id = index_nodes_by_id(overpass_data)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        f.write('<osm version="0.6" generator="uic-mismatch-fixer">')
+        for node_id, lat, lon, uic in mismatches[["id", "latitude", "longitude", "nearest_station_uic"]].itertuples(index=False, name=None):
+            el = nodes_by_id.get(node_id)
+            if not el:
+                continue
+            node = ET.Element("node", id=str(int(node_id)), lat=str(lat), lon=str(lon), version="1", action="modify")
+            tags = el.get("tags", {})
+            for k, v in tags.items():
+                if k != "uic_ref":
+                    ET.SubElement(node, "tag", k=k, v=v)
+            ET.SubElement(node, "tag", k="uic_ref", v=uic)
+            source = tags.get("source", "")
+            source += ";https://github.com/trainline-eu/stations" if source else "https://github.com/trainline-eu/stations"
+            ET.SubElement(node, "tag", k="source", v=source)
+            f.write(ET.tostring(node, encoding="unicode"))
+        f.write("</osm>")
     print(f"✔ XML written to {output_file} with {len(mismatches)} mismatches.")
 
-
 parser = argparse.ArgumentParser(description="Fix mislabelled UIC codes in OSM railway stations.")
 parser.add_argument("--train-csv", required=True, help="Reference Trainline CSV")
 parser.add_argument("--osm-json", help="Optional Overpass cached JSON file")
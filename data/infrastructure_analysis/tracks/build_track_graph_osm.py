@@ -3,14 +3,48 @@ import networkx as nx
 import numpy as np
 from tqdm import tqdm
 from scipy.spatial import cKDTree
-import concurrent.futures
 import pandas as pd
 import os
 import argparse
-from collections import Counter
+from collections import Counter, defaultdict
 from itertools import combinations
 import pickle
 
+STATION_TYPES = {'station', 'halt', 'stop'}
+RAIL_TYPES = {'rail', 'narrow_gauge'}
+
+
+class RailHandler(osmium.SimpleHandler):
+    """
+    Collects station candidates and railway ways in a single pass over an OSM file.
+    Applied with a railway key filter, so that other objects never reach Python.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.station_candidates = []
+        self.rail_ways = []
+        self.node_count = Counter()
+        self.important_nodes = set()
+
+    def node(self, n):
+        if n.tags.get('railway') not in STATION_TYPES:
+            return
+        if any(x in n.tags for x in ['abandoned', 'disused']) or n.tags.get('subway') == 'yes' or n.tags.get('tram') == 'yes':
+            return
+        self.station_candidates.append((n.id, n.location.lat, n.location.lon))
+
+    def way(self, w):
+        if w.tags.get('railway') not in RAIL_TYPES or 'abandoned' in w.tags or 'disused' in w.tags:
+            return
+        # Node references are kept so that the edges can be built without reading the file again
+        way_refs = [nd.ref for nd in w.nodes]
+        self.rail_ways.append(way_refs)
+        for node_ref in way_refs:
+            self.node_count[node_ref] += 1
+            if self.node_count[node_ref] > 1:
+                self.important_nodes.add(node_ref)
+
 def load_station_data(station_file):
     stations_df = pd.read_csv(
         station_file,
@@ -25,28 +59,41 @@ def build_kdtree(stations_df):
     return cKDTree(coords)
 
 
-def find_nearest_stations(batch, tree, stations_df, threshold=100):
-    obj_ids, latitudes, longitudes = zip(*batch)
-    coords = np.column_stack((latitudes, longitudes))
-    distances, indices = tree.query(coords, k=1)
+def find_nearest_stations(candidates, tree, station_names, station_uics, threshold=100):
+    if not candidates:
+        return []
+    obj_ids, latitudes, longitudes = (np.asarray(column) for column in zip(*candidates))
+    # One query for all candidates of a file; the tree parallelises it over all cores
+    distances, indices = tree.query(np.column_stack((latitudes, longitudes)), k=1, workers=-1)
     earth_radius = 6371000
     distances_m = distances * (np.pi / 180) * earth_radius
     valid_mask = distances_m <= threshold
 
-    results = []
-    for obj_id, index, lat, lon in zip(
-        np.array(obj_ids)[valid_mask],
-        np.array(indices)[valid_mask],
-        np.array(latitudes)[valid_mask],
-        np.array(longitudes)[valid_mask]
-    ):
-        name, uic = stations_df.iloc[index][["name", "uic"]]
-        results.append((obj_id, lat, lon, name, uic))
+    matched = indices[valid_mask]
+    return list(zip(
+        obj_ids[valid_mask].tolist(),
+        latitudes[valid_mask].tolist(),
+        longitudes[valid_mask].tolist(),
+        station_names[matched],
+        station_uics[matched]
+    ))
+
+
+def find_root(parent, node):
+    # Union-find lookup with path halving; unseen nodes are their own root
+    while parent.get(node, node) != node:
+        parent[node] = parent.get(parent[node], parent[node])
+        node = parent[node]
+    return node
+
 
-    return results
+def union(parent, a, b):
+    root_a, root_b = find_root(parent, a), find_root(parent, b)
+    if root_a != root_b:
+        parent[root_b] = root_a
 
 
-def process_osm_file(osm_file, stations_df, tree, output_path, station_threshold):
+def process_osm_file(osm_file, station_names, station_uics, tree, output_path, station_threshold):
     output_file = os.path.join(output_path, f'{os.path.basename(osm_file).split("-filtered")[0].split(".")[0]}.gpickle')
 
     if os.path.exists(output_file):
@@ -57,92 +104,54 @@ def process_osm_file(osm_file, stations_df, tree, output_path, station_threshold
         tqdm.write(f"WARNING: OSM file {osm_file} does not exist, skipping.")
         return
 
-    fp = osmium.FileProcessor(osm_file)
-    G = nx.Graph()
     identical_stations_map = {}
-    node_count = Counter()
-    last_appearance = {}
-    important_nodes = set()
-    node_batch = []
-    batch_size = 1000
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
-    futures = []
     uic_to_node = {}
+    station_attrs = {}
 
     # === First Pass: Station nodes and important junctions ===
-    total_nodes = 18977013
-    for i, obj in tqdm(enumerate(fp), total=total_nodes, unit="objects", miniters=10000, desc="First pass", position=1, leave=False):
-        if isinstance(obj, osmium.osm.Node) and obj.tags.get('railway') in ['station', 'halt', 'stop']:
-            if not any(x in obj.tags for x in ['abandoned', 'disused']) and obj.tags.get('subway') != 'yes' and obj.tags.get('tram') != 'yes':
-                lon, lat = obj.location.lon, obj.location.lat
-                node_id = int(obj.id)
-                node_batch.append((node_id, lat, lon))
-
-                if len(node_batch) >= batch_size:
-                    futures.append(executor.submit(find_nearest_stations, node_batch, tree, stations_df, station_threshold))
-                    node_batch = []
-
-        if isinstance(obj, osmium.osm.Way) and obj.tags.get('railway') in ['rail', 'narrow_gauge']:
-            if 'abandoned' in obj.tags or 'disused' in obj.tags:
-                continue
-            if node_batch:
-                futures.append(executor.submit(find_nearest_stations, node_batch, tree, stations_df, station_threshold))
-                node_batch = []
-
-            for nd in obj.nodes:
-                node_ref = int(nd.ref)
-                node_count[node_ref] += 1
-                if node_count[node_ref] > 1:
-                    last_appearance[node_ref] = i
-                    important_nodes.add(node_ref)
-    total_nodes = i + 1
-    executor.shutdown(wait=True)
-
-    for future in tqdm(futures, desc="Matching stations", position=1):
-        for obj_id, lat, lon, name, uic in future.result():
-            important_nodes.add(obj_id)
-            if uic in uic_to_node:
-                identical_stations_map[obj_id] = uic_to_node[uic]
+    handler = RailHandler()
+    handler.apply_file(osm_file, filters=[osmium.filter.KeyFilter('railway')])
+    important_nodes = handler.important_nodes
+    rail_ways = handler.rail_ways
+
+    for obj_id, lat, lon, name, uic in find_nearest_stations(handler.station_candidates, tree, station_names, station_uics, station_threshold):
+        important_nodes.add(obj_id)
+        if uic in uic_to_node:
+            identical_stations_map[obj_id] = uic_to_node[uic]
+        else:
+            station_attrs[obj_id] = {'lat': lat, 'lon': lon, 'name': name, 'uic': uic}
+            uic_to_node[uic] = obj_id
+
+    station_nodes = set(station_attrs)
+
+    # === Second Pass: Create edges from the cached ways ===
+    # Consecutive junctions are merged with union-find instead of contracting them one by one;
+    # stations attached to the same group of junctions are then connected to each other
+    parent = {}
+    station_links = []
+    edges = []
+    for way_refs in tqdm(rail_ways, unit="ways", desc="Processing ways", position=1, leave=False):
+        way_nodes = [identical_stations_map.get(ref, ref) for ref in way_refs if ref in important_nodes]
+        for n1, n2 in zip(way_nodes, way_nodes[1:]):
+            if n1 in station_nodes and n2 in station_nodes:
+                edges.append((n1, n2))
+            elif n1 in station_nodes:
+                station_links.append((n1, n2))
+            elif n2 in station_nodes:
+                station_links.append((n2, n1))
             else:
-                G.add_node(obj_id, lat=lat, lon=lon, name=name, uic=uic)
-                uic_to_node[uic] = obj_id
-
-    station_nodes = set(G.nodes())
-
-    # === Second Pass: Create edges from ways ===
-    fp = osmium.FileProcessor(osm_file)
-    for index, obj in tqdm(enumerate(fp), total=total_nodes, unit="objects", miniters=10000, desc="Processing ways", position=1):
-        if not isinstance(obj, osmium.osm.Way):
-            continue
-        if obj.tags.get('railway') not in ['rail', 'narrow_gauge'] or 'abandoned' in obj.tags or 'disused' in obj.tags:
-            continue
-
-        way_nodes = [int(nd.ref) for nd in obj.nodes if int(nd.ref) in important_nodes]
-        if not way_nodes:
-            continue
-
-        removed_nodes = set()
-        for i in range(len(way_nodes) - 1):
-            n1 = identical_stations_map.get(way_nodes[i], way_nodes[i])
-            n2 = identical_stations_map.get(way_nodes[i + 1], way_nodes[i + 1])
-            G.add_edge(n1, n2)
-
-            if n1 not in station_nodes and last_appearance.get(way_nodes[i], 0) <= index:
-                neighbors = list(G.neighbors(n1))
-                G.add_edges_from(combinations(neighbors, 2))
-                G.remove_node(n1)
-                removed_nodes.add(n1)
-
-        # Handle last node
-        n2 = identical_stations_map.get(way_nodes[-1], way_nodes[-1])
-        if n2 not in station_nodes and last_appearance.get(way_nodes[-1], 0) <= index and n2 in G.nodes:
-            neighbors = list(G.neighbors(n2))
-            G.add_edges_from(combinations(neighbors, 2))
-            G.remove_node(n2)
-            removed_nodes.add(n2)
-
-        for node in removed_nodes:
-            last_appearance.pop(node, None)
+                union(parent, n1, n2)
+
+    stations_by_group = defaultdict(set)
+    for station, junction in station_links:
+        stations_by_group[find_root(parent, junction)].add(station)
+    for stations in stations_by_group.values():
+        edges.extend(combinations(stations, 2))
+
+    # The graph is built in bulk once all edges are known
+    G = nx.Graph()
+    G.add_nodes_from(station_attrs.items())
+    G.add_edges_from(edges)
 
     tqdm.write(f"Number of nodes in the graph: {len(G.nodes())}")
     tqdm.write(f"Number of edges in the graph: {len(G.edges())}")
@@ -165,9 +174,12 @@ args = parser.parse_args()
 # Load stations and KDTree
 stations_df = load_station_data(args.stations)
 tree = build_kdtree(stations_df)
+# Looked up by tree index for every matched station, so extracted from the frame only once
+station_names = stations_df["name"].to_numpy()
+station_uics = stations_df["uic"].to_numpy()
 
 # Collect all filtered railway files
 osm_files = [os.path.join(args.osm_dir, fname) for fname in os.listdir(args.osm_dir) if fname.endswith(".osm.pbf")]
 
 for osm_file in tqdm(osm_files, position=0, desc="Processing OSM files"):
-    process_osm_file(osm_file, stations_df, tree, args.output_dir, args.threshold)
+    process_osm_file(osm_file, station_names, station_uics, tree, args.output_dir, args.threshold)
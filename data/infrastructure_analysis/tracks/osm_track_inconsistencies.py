@@ -1,4 +1,4 @@
-import xml.etree.ElementTree as ET
+import osmium
 import folium
 import argparse
 from collections import defaultdict
@@ -16,39 +16,28 @@ ATTRIBUTES_TO_CHECK = [
 ]
 
 def parse_osm(osm_file):
-    """Parses the OSM XML file and extracts nodes and railway tracks."""
+    """Reads the OSM file (PBF or XML) with osmium and extracts nodes and railway tracks."""
     print("Parsing OSM file...")
     nodes = {}
     tracks = {}
 
-    context = ET.iterparse(osm_file, events=("start", "end"))
-    context = iter(context)
-    event, root = next(context)
-
-    for event, elem in context:
-        if event == "end" and elem.tag == "node":
-            node_id = elem.attrib['id']
-            try:
-                lat = float(elem.attrib['lat'])
-                lon = float(elem.attrib['lon'])
-                nodes[node_id] = (lat, lon)
-            except ValueError:
-                pass
-            elem.clear()
-
-        elif event == "end" and elem.tag == "way":
-            tags = {tag.attrib['k']: tag.attrib['v'] for tag in elem.findall('tag') if tag.attrib['k'] in ATTRIBUTES_TO_CHECK}
-            if tags.get('railway') == 'rail':
-                track_id = elem.attrib['id']
-                node_refs = [nd.attrib['ref'] for nd in elem.findall('nd')]
-                if len(node_refs) >= 2:
-                    tracks[track_id] = {
-                        'nodes': node_refs,
-                        'tags': tags,
-                        'inconsistencies': []
-                    }
-            elem.clear()
-        root.clear()
+    fp = osmium.FileProcessor(osm_file)
+    for obj in fp:
+        if isinstance(obj, osmium.osm.Node):
+            if obj.location.valid():
+                nodes[obj.id] = (obj.location.lat, obj.location.lon)
+
+        elif isinstance(obj, osmium.osm.Way):
+            if obj.tags.get('railway') != 'rail':
+                continue
+            tags = {k: v for k, v in obj.tags if k in ATTRIBUTES_TO_CHECK}
+            node_refs = [nd.ref for nd in obj.nodes]
+            if len(node_refs) >= 2:
+                tracks[obj.id] = {
+                    'nodes': node_refs,
+                    'tags': tags,
+                    'inconsistencies': []
+                }
     return nodes, tracks
 
 def build_endpoint_index(tracks):
@@ -138,7 +127,7 @@ def print_inconsistencies(tracks):
                 print(f"  - {issue}")
 
 parser = argparse.ArgumentParser(description="Check OSM rail track inconsistencies.")
-parser.add_argument("-i", "--input", required=True, help="Input OSM XML file")
+parser.add_argument("-i", "--input", required=True, help="Input OSM file (.osm.pbf or .osm)")
 parser.add_argument("-o", "--output", default="rail_inconsistencies_map.html", help="Output HTML map file")
 args = parser.parse_args()
 
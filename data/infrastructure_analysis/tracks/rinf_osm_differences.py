@@ -1,10 +1,17 @@
 import argparse
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-from geopy.distance import geodesic
 from tqdm import tqdm
-import sqlite3
 import osmium
+from itertools import chain
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+EARTH_RADIUS_KM = 6371.0
 
 def load_rinf_data(csv_path):
     # Load RINF data and rename columns for easier access
@@ -17,11 +24,33 @@ def load_rinf_data(csv_path):
         df[col] = df[col].astype(float)
     return df
 
+def haversine_km(lat1, lon1, lat2, lon2):
+    # Great-circle distances in km between arrays of points given in degrees
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+if njit is not None:
+    # Gathers coordinates and sums segment lengths in one parallel loop, without temporary arrays.
+    # No fastmath: it would let the compiler assume the NaN checks for missing nodes never fire
+    @njit(parallel=True, cache=True)
+    def haversine_sum_km(lats, lons, idx_a, idx_b):
+        total = 0.0
+        for i in prange(idx_a.shape[0]):
+            lat1, lon1 = np.radians(lats[idx_a[i]]), np.radians(lons[idx_a[i]])
+            lat2, lon2 = np.radians(lats[idx_b[i]]), np.radians(lons[idx_b[i]])
+            a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+            if not np.isnan(a):
+                total += np.arcsin(np.sqrt(a))
+        return 2 * EARTH_RADIUS_KM * total
+else:
+    def haversine_sum_km(lats, lons, idx_a, idx_b):
+        return np.nansum(haversine_km(lats[idx_a], lons[idx_a], lats[idx_b], lons[idx_b]))
+
 def compute_geodesic_lengths(df):
-    # Compute straight-line (geodesic) distances between start and end points
-    def _geo_len(row):
-        return geodesic((row["start_lat"], row["start_lng"]), (row["end_lat"], row["end_lng"])).kilometers
-    df["length_calculated_km"] = df.apply(_geo_len, axis=1)
+    # Compute straight-line distances between start and end points, for all rows at once
+    coords = df[["start_lat", "start_lng", "end_lat", "end_lng"]].to_numpy(dtype=float)
+    df["length_calculated_km"] = haversine_km(coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3])
     df["length_diff_km"] = df["length_calculated_km"] - df["length_km"]
     return df
 
@@ -52,39 +81,39 @@ def extract_rail_nodes_and_ways(osm_path, total_objs):
                 needed_nodes.update(nodes)
     return rail_ways, needed_nodes
 
-def store_node_coords(osm_path, needed_nodes, db_path, total_objs):
-    # Second pass: store only relevant node coordinates in a SQLite database
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS nodes(id INTEGER PRIMARY KEY, lat REAL, lon REAL)")
-    c.execute("DELETE FROM nodes")
+def load_node_coords(osm_path, needed_nodes, total_objs):
+    # Second pass: keep only relevant node coordinates, in arrays ordered by node ID
+    found_ids, found_lats, found_lons = [], [], []
     fp = osmium.FileProcessor(osm_path)
-    for obj in tqdm(fp, total=total_objs, desc="writing node coords"):
+    for obj in tqdm(fp, total=total_objs, desc="reading node coords"):
         if isinstance(obj, osmium.osm.Node) and obj.id in needed_nodes:
-            c.execute("INSERT INTO nodes(id, lat, lon) VALUES (?, ?, ?)",
-                      (obj.id, obj.location.lat, obj.location.lon))
-    conn.commit()
-    conn.close()
-
-def compute_osm_length(db_path, rail_ways):
-    # Final pass: calculate total length of OSM railways using stored node coordinates
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    total_km = 0.0
-    for nodes in tqdm(rail_ways, desc="computing distances"):
-        for a, b in zip(nodes, nodes[1:]):
-            c.execute("SELECT lat, lon FROM nodes WHERE id IN (?, ?)", (a, b))
-            rows = c.fetchall()
-            if len(rows) == 2:
-                total_km += geodesic(rows[0], rows[1]).kilometers
-    conn.close()
-    return total_km
+            found_ids.append(obj.id)
+            found_lats.append(obj.location.lat)
+            found_lons.append(obj.location.lon)
+
+    # Nodes missing from the file keep NaN coordinates
+    sorted_ids = np.sort(np.fromiter(needed_nodes, dtype=np.int64, count=len(needed_nodes)))
+    lats = np.full(len(sorted_ids), np.nan)
+    lons = np.full(len(sorted_ids), np.nan)
+    positions = np.searchsorted(sorted_ids, np.asarray(found_ids, dtype=np.int64))
+    lats[positions] = found_lats
+    lons[positions] = found_lons
+    return sorted_ids, lats, lons
+
+def compute_osm_length(node_coords, rail_ways):
+    # Final pass: calculate total length of OSM railways from all consecutive node pairs at once
+    sorted_ids, lats, lons = node_coords
+    first = np.fromiter(chain.from_iterable(nodes[:-1] for nodes in rail_ways), dtype=np.int64)
+    second = np.fromiter(chain.from_iterable(nodes[1:] for nodes in rail_ways), dtype=np.int64)
+    idx_a = np.searchsorted(sorted_ids, first)
+    idx_b = np.searchsorted(sorted_ids, second)
+    # Segments with a node missing from the file have NaN length and are skipped
+    return float(haversine_sum_km(lats, lons, idx_a, idx_b))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process RINF and OSM railway data.")
     parser.add_argument("rinf_csv", help="Path to RINF CSV file")
     parser.add_argument("osm_pbf", help="Path to OSM PBF file")
-    parser.add_argument("--sqlite_db", default="rail_nodes.sqlite", help="Path to SQLite database for node coords")
     parser.add_argument("--total_objects", type=int, default=11525946, help="Total number of OSM objects for progress bars")
     args = parser.parse_args()
 
@@ -102,12 +131,12 @@ if __name__ == "__main__":
     # Show distribution of length discrepancies
     plot_length_differences(df)
 
-    # OSM processing: extract rail segments and store relevant node coords
+    # OSM processing: extract rail segments and load relevant node coords
     rail_ways, needed_nodes = extract_rail_nodes_and_ways(args.osm_pbf, args.total_objects)
-    store_node_coords(args.osm_pbf, needed_nodes, args.sqlite_db, args.total_objects)
+    node_coords = load_node_coords(args.osm_pbf, needed_nodes, args.total_objects)
 
     # Compute total railway length from OSM data
-    total_osm_km = compute_osm_length(args.sqlite_db, rail_ways)
+    total_osm_km = compute_osm_length(node_coords, rail_ways)
 
     print(f"Total OSM railway length: {total_osm_km:.2f} km")
     print(f"Total RINF length: {df['length_km'].sum():.2f} km")